@@ -1,8 +1,11 @@
 """Helper script to the main studentsync.py script that calls all the buildings so it can be scheduled as a task or for testing.
 
 In our district, it takes about an hour to process all 140000 students
+Pass --resume to pick up where the last run left off if it crashed partway through
 """
 
+import sys  # needed to read the command line arguments
+
 from studentsync import *  # include the functions from the main studentsync.py file
 
-sync_students('full')
+sync_students('full', resume='--resume' in sys.argv)
@@ -0,0 +1,10 @@
+"""Helper script to the main studentsync.py script that only processes the students changed since the last run in state reporting buildings, so it can be scheduled to run often.
+
+Pass --full-reconcile to process every student and catch changes made by hand in Google Admin, otherwise that happens automatically every FULL_RECONCILE_HOURS
+"""
+
+import sys  # needed to read the command line arguments
+
+from studentsync import *  # include the functions from the main studentsync.py file
+
+sync_students('limited', delta=True, full_reconcile='--full-reconcile' in sys.argv)
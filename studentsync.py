@@ -6,9 +6,21 @@ Needs the google-api-python-client, google-auth-httplib2 and the google-auth-oau
 # pip install --upgrade google-api-python-client google-auth-httplib2 google-auth-oauthlib
 """
 
+import json  # needed for the JSON lines log output
+import logging  # needed for the leveled, queue backed logging
 import os  # needed for environement variable reading
+import random  # needed for the jitter in the retry backoff
+import sqlite3  # needed for the local state snapshot used by the delta mode
+import sys  # needed to send the console log output to stdout
+import threading  # needed for the locks and thread local storage used by the parallel mode
+from concurrent.futures import ThreadPoolExecutor, as_completed  # needed for the parallel mode worker pool
+from contextlib import contextmanager
 from datetime import *
+from itertools import dropwhile, groupby, islice
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
 from re import A
+from time import monotonic, sleep
 from typing import get_type_hints
 
 # importing module
@@ -49,265 +61,1195 @@ SCOPES = ['https://www.googleapis.com/auth/admin.directory.user', 'https://www.g
 
 LICENSE_PRODUCT_ID = '101031'  # https://developers.google.com/admin-sdk/licensing/v1/how-tos/products
 LICENSE_SKU = '1010310008'
+LICENSE_CUSTOMER_ID = GOOGLE_DOMAIN  # customer ID used to list who holds the license, either the primary domain or the C0xxxxxxx ID from the Admin console
 
-def sync_students(school_mode: any) -> None:
-    """Main function to sync students, needs to be called with 'full', 'limited', or a specific school number."""
-    with open('StudentLog.txt', 'w') as log:
+GOOGLE_PAGE_SIZE = 500  # max number of users returned per page of the users().list call, 500 is the max the API allows
+GOOGLE_PROFILE_FIELDS = 'primaryEmail,aliases,suspended,orgUnitPath,name,customSchemas'  # only request the fields of each user we actually use, cuts down the size of each response
+GOOGLE_USER_FIELDS = f'nextPageToken,users({GOOGLE_PROFILE_FIELDS})'  # the same fields but for each user in a page of users().list results
+BATCH_SIZE = 1000  # number of write requests sent in each batch call to the Google API, 1000 is the max the API allows
+GROUP_CACHE_THRESHOLD = 200  # once this many newly suspended users need their groups looked up in a run, get every group's members at once instead of one lookup per user
+GOOGLE_REQUESTS_PER_SECOND = 40  # max Google API requests per second the script (all the parallel workers combined) will send, the Admin SDK default quota is 2400 per minute per user
+GOOGLE_MIN_REQUESTS_PER_SECOND = 2  # the send rate is cut in half each time Google returns a quota error, but never below this
+GOOGLE_RATE_INCREASE = 1  # how many requests per second the send rate climbs back up by each second that requests go through without quota errors
+RETRY_LIMIT = 6  # how many times a request that hit a quota or server error is retried before giving up and logging the error
+RETRY_BASE_DELAY = 1  # seconds to wait before the first retry, doubled for each retry after that
+RETRY_MAX_DELAY = 64  # max seconds to wait between retries
+RETRYABLE_STATUSES = [429, 500, 502, 503, 504]  # HTTP status codes from Google that are always worth retrying
+RETRYABLE_REASONS = ['userRateLimitExceeded', 'rateLimitExceeded', 'quotaExceeded', 'backendError']  # error reasons that are worth retrying, mostly for the 403s Google uses for quota errors
+PARALLEL_CHUNK_SIZE = 2000  # max number of students given to a worker at once in parallel mode, so large buildings like graduated students are split up between workers
+
+DB_ARRAY_SIZE = 1000  # number of rows fetched from PowerSchool per round trip while streaming the student query results
+
+STATE_DATABASE = 'StudentSyncState.db'  # SQLite file that holds the snapshot of what was last synced for each student, used by the delta mode
+CHECKPOINT_FILE = 'StudentSyncCheckpoint.json'  # JSON file that records how far each school mode's current run has gotten, so it can be resumed if it crashes
+FULL_RECONCILE_HOURS = 24  # how many hours a delta run can go before it does a full reconcile of every student instead, to catch changes made by hand in Google Admin
+
+LOG_FILE = 'StudentLog_{school_mode}_{run_type}.txt'  # the log of the latest run of each school mode and run type (full or delta), the logs of previous runs are kept as .txt.1, .txt.2, etc
+JSON_LOG_FILE = 'StudentLog_{school_mode}_{run_type}.jsonl'  # JSON lines version of the log with the structured fields, only written when sync_students is called with json_log=True
+LOG_BACKUP_COUNT = 5  # how many previous runs worth of logs are kept
+LOG_MAX_BYTES = 100 * 1024 * 1024  # a log file is also rolled over partway through a run if it gets bigger than this
+LOG_LEVEL = logging.DEBUG  # lowest level written to the log files, set to logging.INFO to leave out the DBUG lines
+CONSOLE_LOG_LEVEL = logging.INFO  # lowest level output to the console, which is much slower to write to than the files. If both are INFO the DBUG lines are skipped entirely
+LOG_FORMAT = '%(levelname)s%(separator)s %(message)s'  # separator is filled in by LevelFormatter, a colon except for the error lines that read on from the level
+
+METRICS_DIRECTORY = '.'  # folder the metrics files are written to at the end of each run, point it at the textfile collector folder of node_exporter/windows_exporter to have Prometheus pick them up
+METRICS_FILE_NAME = 'studentsync_{school_mode}_{run_type}'  # name of the metrics files without the extension, a .prom Prometheus textfile and a .json summary are written for each school mode and run type (full, delta or resumed)
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]  # upper bounds in seconds of the Google API latency histogram buckets
+
+logging.addLevelName(logging.DEBUG, 'DBUG')  # keep the same level names the log has always used
+logging.addLevelName(logging.WARNING, 'WARN')
+logger = logging.getLogger('studentsync')
+
+class PhaseTimer:
+    """Adds up the seconds spent in each phase of a run, like db_fetch, google_lookup and update, which are logged as structured fields at the end of the run.
+
+    Phases can be nested, the time spent in an inner phase only counts towards the inner phase. In parallel mode the seconds are added up across all the threads.
+    """
+
+    def __init__(self):
+        self.seconds = {}  # phase name to total seconds
+        self.local = threading.local()  # stack of the nested phases for each thread
+        self.lock = threading.Lock()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.seconds = {}
+
+    @contextmanager
+    def time(self, phase: str):
+        """Context manager that adds the time spent inside it to the phase."""
+        stack = self.local.__dict__.setdefault('stack', [])  # each entry is the seconds spent in phases nested inside of it
+        stack.append(0.0)
+        start = monotonic()
+        try:
+            yield
+        finally:
+            elapsed = monotonic() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                self.seconds[phase] = self.seconds.get(phase, 0.0) + elapsed - nested
+
+    def timed(self, phase: str, iterable):
+        """Wrap an iterator, like the rows streamed from a cursor, so the time spent getting each item counts towards the phase."""
+        iterator = iter(iterable)
+        while True:
+            with self.time(phase):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def write_summary(self, runSeconds: float) -> None:
+        """Output the seconds spent in each phase."""
+        phases = {phase: round(seconds, 3) for phase, seconds in sorted(self.seconds.items())}
+        logger.info(f'Phase timing - DB fetch {phases.get("db_fetch", 0):.1f} seconds, Google lookup {phases.get("google_lookup", 0):.1f} seconds, update {phases.get("update", 0):.1f} seconds, {runSeconds:.1f} seconds total',
+                    extra={'fields': {'phase_seconds': phases, 'run_seconds': round(runSeconds, 3)}})
+
+phaseTimer = PhaseTimer()  # one timer for the whole run, reset at the start of each sync_students call
+
+class Metrics:
+    """Counters for a run that are written to the log and exported to the Prometheus textfile and JSON summary at the end of it.
+
+    Keeps the requests, retries, seconds throttled, errors by reason and a latency histogram for each Google API endpoint, and the number
+    of students and seconds spent on each building. Shared between the worker threads in parallel mode.
+    """
+
+    def __init__(self):
+        self.reset()
+        self.lock = threading.Lock()
+
+    def reset(self) -> None:
+        self.endpoints = {}  # endpoint name to a dict of its counters
+        self.buildings = {}  # school number to a dict of the building name, students and seconds
+
+    def endpoint(self, endpoint: str) -> dict:
+        """Get the counters for an endpoint, creating them the first time it is used. Must be called with the lock held."""
+        return self.endpoints.setdefault(endpoint, {'requests': 0, 'retries': 0, 'throttleSeconds': 0.0, 'errors': {}, 'latencyBuckets': [0] * len(LATENCY_BUCKETS), 'latencySum': 0.0, 'latencyCount': 0})
+
+    def record(self, endpoint: str, requests: int = 0, retries: int = 0, throttleSeconds: float = 0) -> None:
+        """Add to the request, retry and throttle counters for an endpoint."""
+        with self.lock:
+            stats = self.endpoint(endpoint)
+            stats['requests'] += requests
+            stats['retries'] += retries
+            stats['throttleSeconds'] += throttleSeconds
+
+    def record_latency(self, endpoint: str, seconds: float, count: int = 1) -> None:
+        """Add count requests that took this many seconds to the endpoint's latency histogram, every request in a batch takes as long as the whole batch."""
+        with self.lock:
+            stats = self.endpoint(endpoint)
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats['latencyBuckets'][index] += count
+            stats['latencySum'] += seconds * count
+            stats['latencyCount'] += count
+
+    def record_error(self, endpoint: str, reason: str, count: int = 1) -> None:
+        with self.lock:
+            errors = self.endpoint(endpoint)['errors']
+            errors[reason] = errors.get(reason, 0) + count
+
+    def count_students(self, school: tuple, students):
+        """Wrap the students of a building so they are counted towards it as they are streamed through."""
+        count = 0
+        for student in students:
+            count += 1
+            yield student
+        self.record_building(school, students=count)
+
+    def record_building(self, school: tuple, students: int = 0, seconds: float = 0) -> None:
+        """Add to the students and seconds of a building, in parallel mode each chunk of a building adds to the same counters."""
+        with self.lock:
+            building = self.buildings.setdefault(school[1], {'name': school[0].title(), 'students': 0, 'seconds': 0.0})
+            building['students'] += students
+            building['seconds'] += seconds
+
+    def write_summary(self) -> None:
+        """Output the per-endpoint and per-building counters."""
+        for endpoint, stats in sorted(self.endpoints.items()):
+            averageLatency = stats['latencySum'] / stats['latencyCount'] if stats['latencyCount'] else 0
+            errors = ', '.join(f'{reason}: {count}' for reason, count in sorted(stats['errors'].items())) or 'none'
+            logger.info(f'{endpoint} - {stats["requests"]} requests, {stats["retries"]} retries, {stats["throttleSeconds"]:.1f} seconds throttled, {averageLatency:.3f} seconds average latency, errors: {errors}',
+                        extra={'fields': {'endpoint': endpoint, 'requests': stats['requests'], 'retries': stats['retries'], 'throttle_seconds': round(stats['throttleSeconds'], 3), 'errors': stats['errors'], 'average_latency_seconds': round(averageLatency, 4)}})
+        for schoolNum, building in sorted(self.buildings.items()):
+            studentsPerSecond = building['students'] / building['seconds'] if building['seconds'] else 0
+            logger.info(f'Building {building["name"]} | {schoolNum} - {building["students"]} students in {building["seconds"]:.1f} seconds, {studentsPerSecond:.1f} students per second',
+                        extra={'fields': {'school_number': schoolNum, 'school': building['name'], 'students': building['students'], 'seconds': round(building['seconds'], 3), 'students_per_second': round(studentsPerSecond, 3)}})
+
+    def write_files(self, schoolMode: any, runType: str, startDate: datetime, runSeconds: float, phases: dict) -> None:
+        """Write the Prometheus textfile and JSON summary of the run to METRICS_DIRECTORY.
+
+        runType is full, delta or resumed, and goes in the file name and labels so the short delta and resumed runs do not overwrite the numbers of the full runs.
+        """
+        path = os.path.join(METRICS_DIRECTORY, METRICS_FILE_NAME.format(school_mode=schoolMode, run_type=runType))
+        students = sum(building['students'] for building in self.buildings.values())
+        summary = {'school_mode': str(schoolMode), 'run_type': runType, 'started_at': startDate.isoformat(), 'run_seconds': round(runSeconds, 3), 'students': students, 'students_per_second': round(students / runSeconds, 3) if runSeconds else 0,
+                   'phase_seconds': {phase: round(seconds, 3) for phase, seconds in sorted(phases.items())}, 'endpoints': self.endpoints,
+                   'latency_buckets': LATENCY_BUCKETS, 'buildings': {str(schoolNum): building for schoolNum, building in sorted(self.buildings.items())}}
+        with open(path + '.json.tmp', 'w') as file:
+            json.dump(summary, file, indent=2)
+        os.replace(path + '.json.tmp', path + '.json')
+
+        def labels(**values) -> str:
+            """Format Prometheus labels, escaping the characters that are not allowed in a label value."""
+            values = {'school_mode': schoolMode, 'run_type': runType, **values}
+            escaped = {name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in values.items()}
+            return '{' + ','.join(f'{name}="{value}"' for name, value in escaped.items()) + '}'
+
+        lines = []
+        def metric(name: str, metricType: str, description: str, samples: list) -> None:
+            """Add a metric with its HELP and TYPE lines, samples is a list of (suffix, labels, value)."""
+            lines.append(f'# HELP studentsync_{name} {description}')
+            lines.append(f'# TYPE studentsync_{name} {metricType}')
+            for suffix, sampleLabels, value in samples:
+                lines.append(f'studentsync_{name}{suffix}{sampleLabels} {value}')
+
+        endpoints = sorted(self.endpoints.items())
+        metric('google_requests_total', 'counter', 'Google API requests sent, including retries', [('', labels(endpoint=endpoint), stats['requests']) for endpoint, stats in endpoints])
+        metric('google_retries_total', 'counter', 'Google API requests retried after a quota or server error', [('', labels(endpoint=endpoint), stats['retries']) for endpoint, stats in endpoints])
+        metric('google_throttle_seconds_total', 'counter', 'Seconds spent waiting on the rate limiter and retry backoff', [('', labels(endpoint=endpoint), round(stats['throttleSeconds'], 3)) for endpoint, stats in endpoints])
+        metric('google_errors_total', 'counter', 'Google API error responses by reason', [('', labels(endpoint=endpoint, reason=reason), count) for endpoint, stats in endpoints for reason, count in sorted(stats['errors'].items())])
+        latencySamples = []
+        for endpoint, stats in endpoints:
+            latencySamples += [('_bucket', labels(endpoint=endpoint, le=bound), count) for bound, count in zip(LATENCY_BUCKETS, stats['latencyBuckets'])]
+            latencySamples += [('_bucket', labels(endpoint=endpoint, le='+Inf'), stats['latencyCount']), ('_sum', labels(endpoint=endpoint), round(stats['latencySum'], 3)), ('_count', labels(endpoint=endpoint), stats['latencyCount'])]
+        metric('google_request_duration_seconds', 'histogram', 'Seconds each Google API request took, requests sent in a batch take as long as the whole batch', latencySamples)
+        buildings = sorted(self.buildings.items())
+        metric('building_students', 'gauge', 'Students processed in each building', [('', labels(school_number=schoolNum, school=building['name']), building['students']) for schoolNum, building in buildings])
+        metric('building_seconds', 'gauge', 'Seconds spent processing each building, added up across the workers in parallel mode', [('', labels(school_number=schoolNum, school=building['name']), round(building['seconds'], 3)) for schoolNum, building in buildings])
+        metric('building_students_per_second', 'gauge', 'Students processed per second in each building', [('', labels(school_number=schoolNum, school=building['name']), round(building['students'] / building['seconds'], 3) if building['seconds'] else 0) for schoolNum, building in buildings])
+        metric('phase_seconds', 'gauge', 'Seconds spent in each phase of the run', [('', labels(phase=phase), round(seconds, 3)) for phase, seconds in sorted(phases.items())])
+        metric('run_students', 'gauge', 'Students processed in the run', [('', labels(), students)])
+        metric('run_seconds', 'gauge', 'Seconds the run took', [('', labels(), round(runSeconds, 3))])
+        metric('run_students_per_second', 'gauge', 'Students processed per second over the whole run', [('', labels(), summary['students_per_second'])])
+        metric('last_run_timestamp_seconds', 'gauge', 'Unix time the run finished', [('', labels(), round(datetime.now().timestamp()))])
+        with open(path + '.prom.tmp', 'w') as file:  # write to a temp file and swap it in so the collector never reads a half written file
+            file.write('\n'.join(lines) + '\n')
+        os.replace(path + '.prom.tmp', path + '.prom')
+        logger.info(f'Wrote run metrics to {path}.prom and {path}.json')
+
+metrics = Metrics()  # one set of counters for the whole run, reset at the start of each sync_students call
+
+class RateLimiter:
+    """Token bucket shared between all the threads that limits how many Google API requests are sent per second.
+
+    The send rate is adjusted AIMD style, it is cut in half each time Google returns a quota error and climbs back up by GOOGLE_RATE_INCREASE
+    for each second since the last quota error that requests go through, up to the max rate.
+    """
+
+    def __init__(self, rate: float, minRate: float = GOOGLE_MIN_REQUESTS_PER_SECOND):
+        self.maxRate = rate  # the ceiling the rate can climb back up to
+        self.minRate = minRate
+        self.rate = rate  # how many tokens (requests) are added to the bucket per second
+        self.capacity = rate  # max tokens the bucket can hold, which is how big of a burst is allowed
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.increased = self.updated  # when the rate was last increased or cut, the next increase is based on the time since then
+        self.lock = threading.Lock()
+
+    def acquire(self, count: int = 1) -> float:
+        """Take count tokens from the bucket, sleeping until they would have been refilled if there are not enough. Returns the seconds waited."""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count  # the bucket can go negative so large batches just reserve their tokens and following callers wait behind them
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            sleep(wait)
+        return wait
+
+    def throttle(self) -> None:
+        """Multiplicative decrease, called when Google returns a quota error."""
+        with self.lock:
+            self.rate = max(self.minRate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)  # stop any burst that was about to go out
+            self.increased = monotonic()  # the climb back up starts from now, not from before the error
+
+    def succeed(self) -> None:
+        """Additive increase, called when requests went through without a quota error. Adds GOOGLE_RATE_INCREASE for each second since the last increase or cut."""
+        with self.lock:
+            now = monotonic()
+            self.rate = min(self.maxRate, self.rate + GOOGLE_RATE_INCREASE * (now - self.increased))
+            self.increased = now
+
+    def write_summary(self) -> None:
+        logger.info(f'Google API send rate ended at {self.rate:.1f} requests per second')
+
+def get_error_details(er: HttpError) -> dict:
+    """Get the dict with the message and reason from a Google API http error."""
+    if isinstance(er.error_details, list) and er.error_details:
+        return er.error_details[0]  # error_details returns a list with a dict inside of it, just strip it to the first dict
+    return {'message': str(er), 'reason': er.reason}
+
+def get_error_reason(er: Exception) -> str:
+    """Get the reason of a Google API http error like rateLimitExceeded, or the exception type for anything else, used for the error counters."""
+    if isinstance(er, HttpError):
+        return get_error_details(er).get('reason') or str(er.status_code)
+    return type(er).__name__
+
+def is_retryable(er: Exception) -> bool:
+    """Check if an error is a quota or temporary server error that is worth retrying."""
+    return isinstance(er, HttpError) and (er.status_code in RETRYABLE_STATUSES or get_error_details(er).get('reason') in RETRYABLE_REASONS)
+
+def backoff_delay(attempt: int) -> float:
+    """Seconds to wait before retry number attempt (starting at 0), exponential with random jitter so retries from different threads spread out."""
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1)
+
+def get_endpoint(request) -> str:
+    """Get the endpoint name like users.update from a Google API request, used for the counters."""
+    return getattr(request, 'methodId', 'unknown').split('.', 1)[-1]  # the methodId is something like directory.users.update, so strip off the API name
+
+def execute_request(request, limiter: RateLimiter):
+    """Central wrapper for a single Google API execute() call, waits on the rate limiter and retries quota and server errors with backoff."""
+    endpoint = get_endpoint(request)
+    attempt = 0
+    while True:
+        metrics.record(endpoint, requests=1, throttleSeconds=limiter.acquire())
+        startTime = monotonic()
+        try:
+            response = request.execute()
+        except HttpError as er:
+            metrics.record_latency(endpoint, monotonic() - startTime)
+            metrics.record_error(endpoint, get_error_reason(er))
+            if attempt >= RETRY_LIMIT or not is_retryable(er):
+                raise
+            limiter.throttle()
+            delay = backoff_delay(attempt)
+            metrics.record(endpoint, retries=1, throttleSeconds=delay)
+            sleep(delay)
+            attempt += 1
+            continue
+        metrics.record_latency(endpoint, monotonic() - startTime)
+        limiter.succeed()
+        return response
+
+class SyncState:
+    """Local SQLite snapshot of the PowerSchool data and Google state each student was last synced with, used by the delta mode."""
+
+    def __init__(self, path: str = STATE_DATABASE):
+        self.con = sqlite3.connect(path)
+        self.con.execute('CREATE TABLE IF NOT EXISTS students (student_number INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, classof INTEGER, enroll_status INTEGER, schoolid INTEGER, grade_level INTEGER, google_ou TEXT, google_suspended INTEGER, synced_at TEXT)')
+        self.con.execute('CREATE TABLE IF NOT EXISTS runs (school_mode TEXT PRIMARY KEY, last_full_reconcile TEXT)')
+        self.con.commit()
+
+    def load(self) -> dict:
+        """Return a dict of student number to the (student_number, first_name, last_name, classof, enroll_status, schoolid, grade_level) tuple they were last synced with."""
+        return {row[0]: row for row in self.con.execute('SELECT student_number, first_name, last_name, classof, enroll_status, schoolid, grade_level FROM students')}
+
+    def record(self, synced: list, syncedAt: datetime) -> None:
+        """Save the PowerSchool row plus the OU and suspended state written to Google for each (student, googleOU, googleSuspended) that synced successfully."""
+        self.con.executemany('INSERT OR REPLACE INTO students VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [tuple(student) + (googleOU, googleSuspended, syncedAt.isoformat()) for student, googleOU, googleSuspended in synced])
+        self.con.commit()
+
+    def reconcile_due(self, schoolMode: any) -> bool:
+        """Check if it has been more than FULL_RECONCILE_HOURS since the last full run for this school mode."""
+        row = self.con.execute('SELECT last_full_reconcile FROM runs WHERE school_mode = ?', (str(schoolMode),)).fetchone()
+        return not row or datetime.fromisoformat(row[0]) < datetime.now() - timedelta(hours=FULL_RECONCILE_HOURS)
+
+    def set_full_reconcile(self, schoolMode: any, reconciledAt: datetime) -> None:
+        """Record that a full run of this school mode finished."""
+        self.con.execute('INSERT OR REPLACE INTO runs VALUES (?, ?)', (str(schoolMode), reconciledAt.isoformat()))
+        self.con.commit()
+
+    def close(self) -> None:
+        self.con.close()
+
+class Checkpoint:
+    """Entry for one school mode in a JSON file recording the last school_number and student_number its current run got through, so a crashed run can be resumed.
+
+    The students are processed in order of school_number, then student_number descending, so everything before that position is already done.
+    It also records the emails of students whose suspension has been sent but whose group removal has not gone through yet, since once they are
+    suspended a resumed run would not see them as newly suspended. Shared between the worker threads in parallel mode.
+    """
+
+    def __init__(self, schoolMode: any, path: str = CHECKPOINT_FILE):
+        self.schoolMode = str(schoolMode)
+        self.path = path
+        self.lock = threading.Lock()
+
+    def read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as file:
+            return json.load(file)
+
+    def write(self, checkpoints: dict) -> None:
+        """Write the file to a temp file first and then swap it in, so a crash partway through writing does not leave a corrupt checkpoint."""
+        if not checkpoints:  # no school mode has a run in progress
+            os.remove(self.path)
+            return
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(checkpoints, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+    def update(self, change) -> None:
+        """Apply change to this school mode's entry (creating it if needed) and write it back, while holding the lock so threads do not overwrite each other."""
+        with self.lock:
+            checkpoints = self.read()
+            change(checkpoints.setdefault(self.schoolMode, {}))
+            self.write(checkpoints)
+
+    def load(self) -> tuple:
+        """Return the (school_number, student_number) the last unfinished run of this school mode got through, or None if there is not one."""
+        checkpoint = self.read().get(self.schoolMode, {})
+        return (checkpoint['school_number'], checkpoint['student_number']) if 'school_number' in checkpoint else None
+
+    def load_suspending(self) -> set:
+        """Return the emails of students that were suspended by an unfinished run before their group removal went through."""
+        return set(self.read().get(self.schoolMode, {}).get('suspending', []))
+
+    def save(self, schoolNumber: int, studentNumber: int) -> None:
+        """Record that every student up to and including this one has been synced."""
+        self.update(lambda checkpoint: checkpoint.update({'school_number': int(schoolNumber), 'student_number': int(studentNumber), 'saved_at': datetime.now().isoformat()}))
+
+    def add_suspending(self, emails: set) -> None:
+        """Record students whose suspension is about to be sent, before it goes out."""
+        self.update(lambda checkpoint: checkpoint.update({'suspending': sorted(set(checkpoint.get('suspending', [])) | emails)}))
+
+    def remove_suspending(self, emails: set) -> None:
+        """Take students back off the list once their group removal has gone through."""
+        def remove(checkpoint: dict) -> None:
+            suspending = set(checkpoint.pop('suspending', [])) - emails
+            if suspending:
+                checkpoint['suspending'] = sorted(suspending)
+        self.update(remove)
+
+    def clear(self) -> None:
+        """Remove the checkpoint once a run of this school mode finishes, keeping any students whose group removal failed so the next run retries it."""
+        with self.lock:
+            checkpoints = self.read()
+            checkpoint = checkpoints.pop(self.schoolMode, None)
+            if checkpoint is None:
+                return
+            if checkpoint.get('suspending'):
+                checkpoints[self.schoolMode] = {'suspending': checkpoint['suspending']}
+            self.write(checkpoints)
+
+def get_buildings(cur, schoolMode: any):
+    """Run one PowerSchool query for every student in scope along with their school info, and yield a (school, students) pair for each building.
+
+    school is the (name, school_number, abbreviation, State_ExcludeFromReporting) of the building, and students is an iterator of the
+    (student_number, first_name, last_name, classof, enroll_status, schoolid, grade_level) rows streamed from the cursor, which must be used up before moving to the next building.
+    Students matching the BAD_NAMES list are filtered out in the query.
+    """
+    binds = {f'bad{index}': name for index, name in enumerate(BAD_NAMES)}  # bind variable for each bad name so they can be used in the NOT IN lists
+    badNames = ', '.join(':' + bind for bind in binds)
+    # If the mode is "full" we want all schools, if not we only want the main schools not excluded from state reporting, or a specific school number
+    if schoolMode == 'full':  # do every school in PS
+        schoolFilter = ''
+    elif schoolMode == 'limited':  # do only schools that would be in state reporting, aka "real" schools, not the graduated students, pre-registered, etc
+        schoolFilter = 'AND sch.State_ExcludeFromReporting = 0'
+    else:  # otherwise do the specific school number that it could be called with
+        schoolFilter = 'AND sch.school_number = :school'
+        binds['school'] = schoolMode
+    cur.arraysize = DB_ARRAY_SIZE  # fetch the rows in big batches instead of the default 100 so there are fewer round trips to the database
+    cur.prefetchrows = DB_ARRAY_SIZE  # also return the first batch with the query execution itself
+    cur.execute('SELECT stu.student_number, stu.first_name, stu.last_name, stu.classof, stu.enroll_status, stu.schoolid, stu.grade_level, sch.name, sch.abbreviation, sch.State_ExcludeFromReporting '
+                'FROM students stu INNER JOIN schools sch ON stu.schoolid = sch.school_number '
+                f"WHERE NVL(LOWER(stu.first_name), ' ') NOT IN ({badNames}) AND NVL(LOWER(stu.last_name), ' ') NOT IN ({badNames}) {schoolFilter} "
+                'ORDER BY sch.school_number, stu.student_number DESC', binds)
+    for school, rows in groupby(cur, key=lambda row: (row[7], row[5], row[8], row[9])):  # the rows are ordered by school so each building is one group
+        yield school, (row[:7] for row in rows)
+
+def skip_completed(buildings, resumeFrom: tuple):
+    """Skip the buildings and students that a previous run already got through, resumeFrom is the (school_number, student_number) from its checkpoint."""
+    for school, students in buildings:
+        if school[1] < resumeFrom[0]:
+            continue
+        if school[1] == resumeFrom[0]:  # the students are in descending order, so skip everyone down to the last one that was done
+            students = dropwhile(lambda student: int(student[0]) >= resumeFrom[1], students)
+        yield school, students
+
+def get_changed_students(students, snapshot: dict) -> list:
+    """Return only the students whose PowerSchool row is new or different from the snapshot of their last sync."""
+    return [student for student in students if snapshot.get(student[0]) != tuple(student)]
+
+def get_credentials() -> Credentials:
+    """Get credentials from json file, ask for permissions on scope or use existing token.json approval."""
+    creds = None
+    # The file token.json stores the user's access and refresh tokens, and is
+    # created automatically when the authorization flow completes for the first
+    # time.
+    if os.path.exists('token.json'):
+        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+    # If there are no (valid) credentials available, let the user log in.
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+            creds = flow.run_local_server(port=0)
+        # Save the credentials for the next run
+        with open('token.json', 'w') as token:
+            token.write(creds.to_json())
+    return creds
+
+def index_google_user(googleUsers: dict, user: dict) -> None:
+    """Add a user profile to the dictionary under their lowercase primary email and each of their aliases, since the old email= query matched aliases too."""
+    for email in [user.get('primaryEmail')] + user.get('aliases', []):
+        googleUsers[email.lower()] = user
+
+def get_google_users(service, limiter: RateLimiter) -> dict:
+    """Page through every user in the Google domain once and return a dictionary of their profiles keyed by lowercase primary email and aliases."""
+    googleUsers = {}  # dict that will hold the user profiles, the key is the email or alias and value is the user dict from the API
+    pageToken = None
+    pages = 0
+    users = 0
+    while True:
+        results = execute_request(service.users().list(customer='my_customer', domain=GOOGLE_DOMAIN, maxResults=GOOGLE_PAGE_SIZE, projection='full', fields=GOOGLE_USER_FIELDS, pageToken=pageToken), limiter)
+        for user in results.get('users', []):
+            index_google_user(googleUsers, user)
+            users += 1
+        pages += 1
+        pageToken = results.get('nextPageToken')
+        if not pageToken:  # once there is no next page token we have gotten every user
+            break
+    logger.info(f'Retrieved {users} Google users in {pages} pages')
+    return googleUsers
+
+class BatchQueue:
+    """Queue of Google API requests that are sent through the batch endpoint instead of one execute() call each.
+
+    Each request has its own callback so an error on one student is logged and does not fail the rest of the batch. Requests that hit quota or
+    server errors are put back in the queue and retried with backoff, up to RETRY_LIMIT times.
+    """
+
+    def __init__(self, service, limiter: RateLimiter, phase: str = 'update', batchSize: int = BATCH_SIZE, onSend=None):
+        self.service = service  # the API service the requests belong to, batches can only contain requests for a single API
+        self.limiter = limiter  # rate limiter shared between threads, each request in a batch counts against the quota separately
+        self.phase = phase  # phase of the run the time spent sending the batches counts towards
+        self.batchSize = batchSize
+        self.pending = []  # list of (request, description, key, onSuccess, onError, attempt) tuples waiting to be sent
+        self.retries = []  # items from the current batch that need to be retried
+        self.failed = set()  # keys (emails) of any requests that came back with an error
+        self.flushing = False  # flag so requests queued from inside a callback don't start a nested batch
+        self.batches = 0  # how many batches have been sent, so callers can tell when a flush happened
+        self.callbackSeconds = 0.0  # time spent in the onSuccess callbacks of the current batch, which is not part of the request latency
+        self.onSend = onSend  # called with the keys of each batch right before it is sent
+
+    def add(self, request, description: str, key: str = None, onSuccess=None, onError=None) -> None:
+        """Queue a request, sending the batch once it is full.
+
+        onSuccess is called with the response and can queue follow up requests. onError is called with any HttpError, and if it returns True the error is treated as handled and not logged.
+        """
+        self.pending.append((request, description, key, onSuccess, onError, 0))
+        if len(self.pending) >= self.batchSize and not self.flushing:
+            self.flush()
+
+    def flush(self) -> None:
+        """Send everything that is queued, including any follow up requests queued by callbacks and retries, in batches of up to batchSize."""
+        self.flushing = True
+        try:
+            with phaseTimer.time(self.phase):  # count the time spent sending towards the update phase, or google_lookup for the lookup queues
+                while self.pending:
+                    items = self.pending[:self.batchSize]
+                    self.pending = self.pending[self.batchSize:]
+                    self.retries = []
+                    batch = self.service.new_batch_http_request()
+                    for index, item in enumerate(items):
+                        batch.add(item[0], callback=self._make_callback(item), request_id=str(index))
+                    wait = self.limiter.acquire(len(items))
+                    endpoints = {}  # endpoint name to the number of requests for it in this batch
+                    for item in items:
+                        endpoints[get_endpoint(item[0])] = endpoints.get(get_endpoint(item[0]), 0) + 1
+                    for endpoint, count in endpoints.items():
+                        metrics.record(endpoint, requests=count, throttleSeconds=wait * count / len(items))
+                    self.batches += 1
+                    if self.onSend:
+                        self.onSend({item[2] for item in items})
+                    self.callbackSeconds = 0.0
+                    startTime = monotonic()
+                    try:
+                        batch.execute()
+                    except Exception as er:  # an error on the batch call itself rather than an individual request, so none of the items were processed
+                        for endpoint, count in endpoints.items():
+                            metrics.record_error(endpoint, get_error_reason(er), count)
+                        if is_retryable(er) and max(item[5] for item in items) < RETRY_LIMIT:
+                            self.retries = list(items)
+                        else:
+                            for item in items:
+                                logger.error(f'while {item[1]}: {er}', extra={'inline': True})
+                                self.failed.add(item[2])
+                    for endpoint, count in endpoints.items():
+                        metrics.record_latency(endpoint, monotonic() - startTime - self.callbackSeconds, count)
+                    if self.retries:  # slow down, wait, then put the requests that hit quota errors back at the front of the queue
+                        self.limiter.throttle()
+                        delay = backoff_delay(max(item[5] for item in self.retries))
+                        logger.warning(f'{len(self.retries)} Google API requests hit quota or server errors, retrying them in {delay:.1f} seconds')
+                        for item in self.retries:
+                            metrics.record(get_endpoint(item[0]), retries=1, throttleSeconds=delay / len(self.retries))
+                        sleep(delay)
+                        self.pending = [item[:5] + (item[5] + 1,) for item in self.retries] + self.pending
+                    else:  # only climb back up after a batch that went through without any quota errors
+                        self.limiter.succeed()
+        finally:
+            self.flushing = False
+
+    def _make_callback(self, item: tuple):
+        """Build the per-request callback that routes errors into the normal error log format, or into the retry list for quota errors."""
+        request, description, key, onSuccess, onError, attempt = item
+        def callback(requestId, response, exception):
+            if exception is None:
+                if onSuccess:
+                    callbackStart = monotonic()
+                    try:
+                        onSuccess(response)
+                    except Exception as er:  # the request itself went through, so only this key failed and the rest of the batch carries on
+                        self.failed.add(key)
+                        logger.error(f'after {description}: {er}', extra={'inline': True})
+                    finally:
+                        self.callbackSeconds += monotonic() - callbackStart
+                return
+            metrics.record_error(get_endpoint(request), get_error_reason(exception))
+            if onError and isinstance(exception, HttpError) and onError(exception):
+                return
+            if is_retryable(exception) and attempt < RETRY_LIMIT:
+                self.retries.append(item)
+                return
+            self.failed.add(key)
+            if isinstance(exception, HttpError):   # catch Google API http errors, get the specific message and reason from them for better logging
+                status = exception.status_code
+                details = get_error_details(exception)
+                logger.error(f'{status} from Google API while {description}: {details["message"]}. Reason: {details["reason"]}', extra={'inline': True})
+            else:
+                logger.error(f'while {description}: {exception}', extra={'inline': True})
+        return callback
+
+def get_google_users_by_email(service, emails: list, limiter: RateLimiter) -> tuple:
+    """Look up just the given emails in Google with batched users().get calls, used by the delta mode instead of getting the whole domain.
+
+    Returns the dict of found users in the same format as get_google_users, and the set of emails whose lookup failed for a reason other than not existing.
+    """
+    googleUsers = {}
+    lookupQueue = BatchQueue(service, limiter, 'google_lookup')
+    for email in emails:
+        lookupQueue.add(service.users().get(userKey=email, projection='full', fields=GOOGLE_PROFILE_FIELDS), f'looking up {email}', email,
+                        onSuccess=lambda user: index_google_user(googleUsers, user), onError=lambda er: er.status_code == 404)  # a 404 just means they do not have an account yet
+    lookupQueue.flush()
+    return googleUsers, lookupQueue.failed
+
+def get_licensed_users(licenseService, limiter: RateLimiter) -> set:
+    """Page through everyone that holds the LICENSE_PRODUCT_ID - LICENSE_SKU license and return a set of their lowercase emails."""
+    licensedUsers = set()
+    pageToken = None
+    while True:
+        results = execute_request(licenseService.licenseAssignments().listForProductAndSku(productId=LICENSE_PRODUCT_ID, skuId=LICENSE_SKU, customerId=LICENSE_CUSTOMER_ID, maxResults=1000, fields='nextPageToken,items(userId)', pageToken=pageToken), limiter)
+        for assignment in results.get('items', []):
+            licensedUsers.add(assignment.get('userId').lower())
+        pageToken = results.get('nextPageToken')
+        if not pageToken:
+            break
+    logger.info(f'Retrieved {len(licensedUsers)} users with license {LICENSE_PRODUCT_ID} - {LICENSE_SKU}')
+    return licensedUsers
+
+class GroupCache:
+    """Map of user email to the groups they are a direct member of, built from the member lists of every group in the domain.
+
+    It is only built once GROUP_CACHE_THRESHOLD users have needed their groups looked up in a run, so runs with only a few suspensions
+    stick to one groups().list per user instead of paying to list every group. Shared between the worker threads in parallel mode.
+    """
+
+    def __init__(self, limiter: RateLimiter):
+        self.limiter = limiter
+        self.lookups = 0  # how many users have needed their groups looked up so far
+        self.userGroups = None  # email to list of group dicts, None until it is built
+        self.failed = False  # set if building the map failed so it is not tried again
+        self.lock = threading.Lock()
+
+    def get(self, email: str, service):
+        """Return the list of groups the user is in if the cache is built (building it once the threshold is hit), otherwise None to use a groups().list lookup."""
+        with self.lock:
+            self.lookups += 1
+            if self.userGroups is None and not self.failed and self.lookups >= GROUP_CACHE_THRESHOLD:
+                with phaseTimer.time('google_lookup'):
+                    self.build(service)
+            if self.userGroups is None:
+                return None
+            return self.userGroups.get(email.lower(), [])
+
+    def build(self, service) -> None:
+        """List every group in the domain, then queue a batched members().list for each group to fill in the map."""
+        logger.info(f'{self.lookups} users have needed their groups looked up, getting the members of every group instead')
+        userGroups = {}
+        memberQueue = BatchQueue(service, self.limiter, 'google_lookup')
+
+        def add_members(response: dict, group: dict) -> None:
+            """Callback for a page of members of a group, adds them to the map and queues the next page if there is one."""
+            for member in response.get('members', []):
+                if member.get('email'):
+                    userGroups.setdefault(member.get('email').lower(), []).append(group)
+            if response.get('nextPageToken'):
+                queue_members(group, response.get('nextPageToken'))
+
+        def queue_members(group: dict, pageToken: str = None) -> None:
+            memberQueue.add(service.members().list(groupKey=group.get('email'), maxResults=200, fields='nextPageToken,members(email)', pageToken=pageToken), f'getting members of group {group.get("email")}', group.get('email'),
+                            onSuccess=lambda response: add_members(response, group))
+
+        groupCount = 0
+        pageToken = None
+        try:
+            while True:
+                results = execute_request(service.groups().list(customer='my_customer', maxResults=200, fields='nextPageToken,groups(email,name)', pageToken=pageToken), self.limiter)
+                for group in results.get('groups', []):
+                    queue_members(group)
+                    groupCount += 1
+                pageToken = results.get('nextPageToken')
+                if not pageToken:
+                    break
+        except Exception as er:  # this runs inside the callback of another batch, so an error here must not escape into that batch
+            logger.error(f'Could not list the groups in the domain, group lookups will continue to be done per user: {er}')
+            self.failed = True
+            return
+        memberQueue.flush()
+        if memberQueue.failed:  # if any of the member lists could not be retrieved the map would be missing groups, so keep using the per user lookups
+            logger.error(f'Could not get the members of {len(memberQueue.failed)} groups, group lookups will continue to be done per user')
+            self.failed = True
+            return
+        self.userGroups = userGroups
+        logger.info(f'Cached the members of {groupCount} groups')
+
+def plan_students(school: tuple, students, googleUsers: dict, startDate: datetime, licensedUsers: set = None, pendingGroupRemovals: set = None):
+    """Work out the changes needed for a list (or iterator) of students from one building without making any Google API calls.
+
+    school is the (name, school_number, abbreviation, State_ExcludeFromReporting) of the building. Yields a plan dict for each student with their
+    student row, email, the googleOU and googleSuspended state they should end up with, and a list of change records. Each change record is a dict
+    with an action of 'create', 'update', 'suspend', 'remove_groups' or 'remove_license', the email, and the fields to send for create/update/suspend.
+    For remove_groups and remove_license the email is the primary email of the account, since the student email can be one of its aliases.
+    If the set of licensedUsers is passed in, license removals are only planned for users that actually hold the license. Any already suspended
+    users in the set of pendingGroupRemovals, from a run that crashed after suspending them, get their group removal planned again.
+    """
+    # store results in variables mostly just for readability
+    schoolName = school[0].title()  # convert to title case since some are all caps
+    schoolNum = school[1]
+    schoolAbbrev = school[2]
+    # construct the string for the organization unit in Google Admin from the building name + students
+    orgUnit = OU_PREFIX + schoolAbbrev + ' Students'
+    if schoolName == GRADUATED_SCHOOL_NAME:  # check and see if our building is the graduated students building or enroll status is graduated since they have a different OU then the rest
+        orgUnit = GRADUATED_OU
+    logger.debug('Starting Building: %s | %s | %s', schoolName, schoolNum, orgUnit)  # debug
+
+    for student in students:
+        try:
+            bodyDict = {}  # define empty dict that will hold the update parameters
+            changes = []  # list of the change records for this student
+            # logger.debug(student)
+            stuNum = int(student[0])
+            firstName = str(student[1]).title()
+            lastName = str(student[2]).title()
+            email = str(stuNum) + EMAIL_SUFFIX
+            gradYear = int(student[3])
+            enroll = int(student[4])
+            school = int(student[5])
+            grade = int(student[6])
+
+            currentYear = int(startDate.strftime("%Y"))  # get the current year as a integer from the start time
+            currentMonth = startDate.strftime("%B")  # get the current month name as a string
+
+            # next find the students account in the prefetched Google users based on their email, will be None if they do not have one
+            googleUser = googleUsers.get(email.lower())
+
+            suspended = False if enroll == 0 or enroll == -1 else True  # create a flag for whether they should be suspended or not, will be based on their enroll status
+            # override graduated students being suspended for the months of july and august so they can still access their emails until september 1st
+            if gradYear == currentYear and GRADUATED_ACTIVE_SUMMER:  # check current year against grad year
+                if currentMonth == "June" or currentMonth == "July" or currentMonth == "August":  # check if it is currently July or August
+                    if schoolName == GRADUATED_SCHOOL_NAME and enroll == 3:  # make sure the student is in the graduated students building and status of graduated
+                        suspended = False
+                        logger.warning(f'{email} is a {currentYear} graduate, they will remain active until September 1st')
+                        # remove their license as my other script only removes them once they are suspended, but that overlaps with new school year licensing
+                        licenseEmail = googleUser.get('primaryEmail').lower() if googleUser else email.lower()  # the license is held by the primary email, which differs if the student email is an alias
+                        if licensedUsers is None or licenseEmail in licensedUsers:  # skip the removal if we know they no longer have the license
+                            logger.info(f'Removing license {LICENSE_PRODUCT_ID} - {LICENSE_SKU} from graduated student {email}')
+                            changes.append({'action': 'remove_license', 'email': licenseEmail})
+
+
+            # set the OU path based on their school, grades, enroll status, etc
+            properOU = orgUnit + GRADE_OUS.get(grade)  # for enabled accounts at normal buildings, they get the overall building OU + the grade level sub-OU
+            # have a section to set OU for pre registered and graduated students separately as it does not include any grade sub-ous
+            if school == 999999 or enroll == 3 or school == 901 or enroll == -1:
+                properOU = orgUnit
+            # if they are just suspended (but not graduated), they get the normal suspended OU
+            if suspended and (school != 999999 and enroll != 3):
+                properOU = SUSPENDED_OU
+
+
+            # debug lines use % style arguments instead of f-strings so the message is never built when debug logging is turned off
+            logger.debug('User %s, Name: %s %s, school: %s, grade: %s, graduation year: %s, enroll: %s, suspended: %s, OU path: %s', email, firstName, lastName, school, grade, gradYear, enroll, suspended, properOU)
+
+            # process all the active students
+            if not suspended:
+                # logger.debug('enabled')
+                if googleUser:  # if we found a user in Google that matches the user email, they already exist and we just want to update any info
+                    frozen = False  # define a flag for whether they are in a frozen OU, set to false initially
+
+                    # get info from their account
+                    currentlySuspended = googleUser.get('suspended')
+                    currentOU = googleUser.get('orgUnitPath')
+                    # logger.debug(f'Student {email} already has an existing Google account, updating any info')
+
+                    # check to see if the user is enabled in Google, if not add that to the update body
+                    if currentlySuspended == True:
+                        bodyDict.update({'suspended': False})
+
+                    # Check to see if they are in the correct OU (which is based on home building assignment)
+                    if currentOU != properOU:
+                        for org in FROZEN_OUS:  # go through our list of "frozen" OU paths which contain a few users with custom settings, licenses, etc
+                            if org in currentOU:  # check and see if the frozen OU path is part of the OU they are currently in, if so set the frozen flag to True
+                                frozen = True
+                        if frozen:  # if they are in a frozen OU we do not add the change, but just print out an info line for logging
+                            logger.warning(f'User {email} is in the frozen OU {currentOU} and will not be moved to {properOU}')
+                        else:  # if theyre not in a frozen OU they will have the orgunit change added to the body of the update
+                            logger.info(f'User {email} not in a frozen OU, will to be moved from {currentOU} to {properOU}')
+                            bodyDict.update({'orgUnitPath' : properOU})  # add OU to body of the update
+
+                    # Check to see if the student's name has changed significantly, if so update the name in Google
+                    currentFirstName = googleUser.get('name').get('givenName')
+                    currentLastName = googleUser.get('name').get('familyName')
+                    if currentFirstName.upper() != firstName.upper():
+                        logger.info(f'User {email} has changed first name from {currentFirstName} to {firstName}, updating')
+                        bodyDict.update({'name' : {'givenName' : firstName}})
+                    if currentLastName.upper() != lastName.upper():
+                        logger.info(f'User {email} has changed last name from {currentLastName} to {lastName}, updating')
+                        bodyDict.update({'name' : {'familyName' : lastName}})
+
+                    # get custom attributes info from their google profile
+                    try:  # put the retrieval of the custom data in a try/except block because some accounts might not have the data, which will then need to be added
+                        currentSchool = int(googleUser.get('customSchemas').get(CUSTOM_ATTRIBUTE_CATEGORY).get(CUSTOM_ATTRIBUTE_SCHOOL))  # take the user's custom schema homeschool id and store it
+                        currentGrad = int(googleUser.get('customSchemas').get(CUSTOM_ATTRIBUTE_CATEGORY).get(CUSTOM_ATTRIBUTE_GRADYEAR))  # take the user's custom schema graduation year and store it
+                        if (currentSchool != school or currentGrad != gradYear):
+                            logger.info(f'Updating {email}. School from {currentSchool} to {school}, Graduation Year from {currentGrad} to {gradYear}')
+                            bodyDict.update({'customSchemas' : {CUSTOM_ATTRIBUTE_CATEGORY : {CUSTOM_ATTRIBUTE_SCHOOL : school, CUSTOM_ATTRIBUTE_GRADYEAR : gradYear}}})
+                    except Exception as er:
+                        logger.error(f'User {email} had no or was missing Synchronization_Data, it will be created: ({er})')
+                        # Since the error was probably not having any synchronization data for whatever reason, it should be added to the body of the update
+                        logger.info(f'Updating {email}. School to {school}, Graduation Year to {gradYear}')
+                        bodyDict.update({'customSchemas' : {CUSTOM_ATTRIBUTE_CATEGORY : {CUSTOM_ATTRIBUTE_SCHOOL : school, CUSTOM_ATTRIBUTE_GRADYEAR : gradYear}}})
+
+                    # Finally, do the actual update of the user profile, using the bodyDict we have constructed in the above sections
+                    if bodyDict:  # if there is anything in the body dict we want to update. if its empty we skip the update
+                        logger.debug('Update for %s: %s', email, bodyDict)  # debug
+                        changes.append({'action': 'update', 'email': email, 'fields': bodyDict})
+                # if there is no google result for our email query, we should try to create a new email account
+                else:
+                    logger.info(f'User {email} does not exist, will be created')
+                    # define the new user email, name, and all the basic fields
+                    newUser = {'primaryEmail' : email, 'name' : {'givenName' : firstName, 'familyName' : lastName}, 'password' : NEW_PASSWORD, 'changePasswordAtNextLogin' : True, 'orgUnitPath' : properOU,
+                            'customSchemas' : {CUSTOM_ATTRIBUTE_CATEGORY : {CUSTOM_ATTRIBUTE_SCHOOL : school, CUSTOM_ATTRIBUTE_GRADYEAR : gradYear}}}
+                    changes.append({'action': 'create', 'email': email, 'fields': newUser})
+
+            # process all the inactive students
+            else:
+                # logger.debug(f'User {email} is inactive, should be suspended')
+                if googleUser:  # if we found a user in Google that matches the user email, they already exist and we just want to update any info
+                    # get info from their account
+                    currentlySuspended = googleUser.get('suspended')
+                    currentOU = googleUser.get('orgUnitPath')
+                    if not currentlySuspended:
+                        logger.info(f'Suspending {email}')
+                        bodyDict.update({'suspended' : True})  # add the suspended: True to the body of the update patch
+                    if currentOU != properOU:
+                        logger.info(f'Moving {email} to suspended OU {properOU}')
+                        bodyDict.update({'orgUnitPath' : properOU})  # add the suspended OU to the org unit path for the update patch
+
+                    # finally do the update (suspend and move) if we have anything in the bodyDict
+                    if bodyDict:
+                        logger.debug('Update for %s: %s', email, bodyDict)
+                        # suspend and move them, then remove the newly suspended user from any groups they were a member of
+                        changes.append({'action': 'suspend', 'email': email, 'fields': bodyDict})
+                        changes.append({'action': 'remove_groups', 'email': googleUser.get('primaryEmail').lower()})
+                    elif pendingGroupRemovals and email in pendingGroupRemovals:  # suspended by a run that crashed before their group removal went through
+                        logger.info(f'{email} was suspended by an unfinished run, they will be removed from any groups')
+                        changes.append({'action': 'remove_groups', 'email': googleUser.get('primaryEmail').lower()})
+                    # else:  # handles if they were already suspended and no change needed
+                        # logger.debug(f'{email} is already suspended in the correct suspended accounts OU, no update needed')
+                # else:  # if we did not find any google accounts matching the email, just give a warning
+                    # logger.debug(f'Found inactive student {email} without Google account that matches.')
+
+        except Exception as er:
+            logger.error(f'while processing student {student[0]}: {er}', extra={'inline': True})
+            continue  # skip the student, they will not be saved to the SyncState so they get tried again next run
+        yield {'student': student, 'email': email, 'googleOU': properOU, 'googleSuspended': suspended, 'changes': changes}
+
+def apply_changes(plans, service, licenseService, limiter: RateLimiter, dryRun: bool = False, groupCache: GroupCache = None, onCommit=None, checkpoint: Checkpoint = None) -> list:
+    """Take the student plans from plan_students and send their changes to Google in batches, using the groupCache for group removals if passed in.
+
+    In dry run mode the changes are only logged and nothing is sent to Google. Returns a list of (student, googleOU, googleSuspended) for each
+    student whose changes all went through without errors, to be saved in the SyncState. Each time a full batch is sent, everything else queued
+    is sent as well and onCommit is called with that list for the students so far and the row of the last student, so progress can be saved.
+    If a checkpoint is passed in, suspensions are recorded in it before they are sent and taken off once the group removals are done.
+    """
+    unrecorded = set()  # emails with a suspension queued that has not been recorded in the checkpoint yet
+    groupRemovals = set()  # emails with a group removal since the last commit
+
+    def record_suspensions(keys: set) -> None:
+        """Called right before each directory batch is sent, records any suspensions in it so a crash before their group removal can be caught on resume."""
+        sending = keys & unrecorded
+        if sending:
+            checkpoint.add_suspending(sending)
+            unrecorded.difference_update(sending)
+
+    # queues that hold the write requests so they can be sent to Google in batches instead of one at a time
+    directoryQueue = BatchQueue(service, limiter, onSend=record_suspensions if checkpoint else None)
+    licenseQueue = BatchQueue(licenseService, limiter)
+
+    def remove_groups(groupsResponse: dict, email: str) -> None:
+        """Callback for the groups().list of a newly suspended user, queues the removal from each group they are in."""
+        userGroups = groupsResponse.get('groups')  # get the current groups the user is in
+        if userGroups:
+            for group in userGroups:  # if they have groups they are still a member of, go through each group and remove them
+                name = group.get('name')
+                groupEmail = group.get('email')
+                logger.info(f'{email} was a member of: {name} - {groupEmail}, they will be removed from the group')
+                directoryQueue.add(service.members().delete(groupKey=groupEmail, memberKey=email), f'removing {email} from group {groupEmail}', email)
+        else:
+            logger.debug('Newly suspended account %s was not in any groups, no removal needed', email)
+
+    def queue_group_removal(email: str, primaryEmail: str) -> None:
+        """Queue the removal of a user from each of their groups, getting their groups from the cache (which is keyed by primary email) or with a groups().list lookup."""
+        userGroups = groupCache.get(primaryEmail, service) if groupCache else None
+        if userGroups is not None:
+            remove_groups({'groups': userGroups}, email)
+        else:
+            directoryQueue.add(service.groups().list(userKey=email), f'getting groups for {email}', email, onSuccess=lambda groups: remove_groups(groups, email))
+
+    def commit() -> list:
+        """Send everything still queued, then return the students processed since the last commit whose changes all went through."""
+        directoryQueue.flush()
+        licenseQueue.flush()
+        failed = directoryQueue.failed | licenseQueue.failed  # emails that had an error on any of their requests
+        synced = [(student, googleOU, googleSuspended) for student, googleOU, googleSuspended, email in processed if email not in failed]
+        if onCommit and processed:
+            onCommit(synced, processed[-1][0])
+        if checkpoint and groupRemovals:
+            checkpoint.remove_suspending(groupRemovals - failed)  # anyone whose group removal failed stays on the list for the next run to retry
+        groupRemovals.clear()
+        processed.clear()
+        return synced
+
+    processed = []  # list of (student, googleOU, googleSuspended, email) for each student whose changes were queued since the last commit
+    synced = []
+    batches = 0  # batches sent by both queues as of the last commit
+    for plan in plans:
+        email = plan['email']
+        actions = [change['action'] for change in plan['changes']]
+        primaryEmail = next((change['email'] for change in plan['changes'] if change['action'] == 'remove_groups'), email)  # the student email may only be an alias of their account
+        for change in plan['changes']:
+            if dryRun:  # just output the change that would be made, hiding the new user password so it does not end up in the log
+                shownChange = {**change, 'fields': {**change['fields'], 'password': '********'}} if 'password' in change.get('fields', {}) else change
+                logger.info(f'DRY RUN: {shownChange}')
+                continue
+            if change['action'] == 'create':
+                directoryQueue.add(service.users().insert(body=change['fields']), f'creating user account for {email}', email)  # queue the actual account creation
+            elif change['action'] == 'update':
+                directoryQueue.add(service.users().update(userKey = email, body=change['fields']), f'updating {email}', email)  # queue the actual updating of the user profile
+            elif change['action'] == 'suspend':
+                # queue the update, and once it succeeds queue the lookup of their groups so the newly suspended user can be removed from any groups they were a member of
+                onSuccess = (lambda response, email=email, primaryEmail=primaryEmail: queue_group_removal(email, primaryEmail)) if 'remove_groups' in actions else None
+                directoryQueue.add(service.users().update(userKey = email, body=change['fields']), f'suspending {email}', email, onSuccess=onSuccess)
+            elif change['action'] == 'remove_groups':
+                groupRemovals.add(email)
+                if 'suspend' in actions:  # if they are being suspended this gets queued once the suspension goes through
+                    unrecorded.add(email)
+                else:
+                    queue_group_removal(email, primaryEmail)
+            elif change['action'] == 'remove_license':
+                licenseQueue.add(licenseService.licenseAssignments().delete(productId=LICENSE_PRODUCT_ID, skuId=LICENSE_SKU, userId=change['email']), f'removing license from graduated student {email}', email)  # queue the actual removal of the license
+        processed.append((plan['student'], plan['googleOU'], plan['googleSuspended'], email))
+        if directoryQueue.batches + licenseQueue.batches != batches:  # a full batch just went out, so send the rest and commit everyone up to this student
+            synced += commit()
+            batches = directoryQueue.batches + licenseQueue.batches
+
+    if dryRun:  # nothing was actually changed so nothing should be saved as synced
+        return []
+    return synced + commit()  # send any writes still queued
+
+def sync_building(school: tuple, students, googleUsers: dict, service, licenseService, startDate: datetime, limiter: RateLimiter, dryRun: bool = False, licensedUsers: set = None, groupCache: GroupCache = None,
+                  onCommit=None, pendingGroupRemovals: set = None, checkpoint: Checkpoint = None) -> list:
+    """Sync the Google accounts of a list (or iterator) of students from one building, streaming the planned changes of each student straight into the apply stage.
+
+    Returns a list of (student, googleOU, googleSuspended) for each student that was synced without any errors, to be saved in the SyncState.
+    """
+    startTime = monotonic()
+    plans = plan_students(school, metrics.count_students(school, students), googleUsers, startDate, licensedUsers, pendingGroupRemovals)
+    synced = apply_changes(plans, service, licenseService, limiter, dryRun, groupCache, onCommit, checkpoint)
+    metrics.record_building(school, seconds=monotonic() - startTime)
+    return synced
+
+workerClients = threading.local()  # holds the Google API clients for each worker thread, since the httplib2 clients are not thread-safe
+
+def init_worker(creds: Credentials) -> None:
+    """Thread pool initializer that builds a separate set of Google API clients for each worker thread."""
+    workerClients.service = build('admin', 'directory_v1', credentials=creds)
+    workerClients.licenseService = build('licensing', 'v1', credentials=creds)
+
+def sync_building_worker(school: tuple, students: list, googleUsers: dict, startDate: datetime, limiter: RateLimiter, dryRun: bool, licensedUsers: set, groupCache: GroupCache,
+                         pendingGroupRemovals: set, checkpoint: Checkpoint) -> tuple:
+    """Run sync_building in a worker thread, returning the log records it held back so each chunk can be written to the log as its own section, the list of synced students, and whether the chunk finished."""
+    workerClients.records = []  # hold_worker_records puts everything logged by this thread in here instead of sending it to the log
+    synced = []
+    finished = False
+    try:
+        synced = sync_building(school, students, googleUsers, workerClients.service, workerClients.licenseService, startDate, limiter, dryRun, licensedUsers, groupCache, pendingGroupRemovals=pendingGroupRemovals, checkpoint=checkpoint)
+        finished = True
+    except Exception as er:
+        logger.error(f'while processing building {school[1]}: {er}', extra={'inline': True})
+    finally:
+        records = workerClients.records
+        workerClients.records = None
+    return records, synced, finished
+
+def hold_worker_records(record: logging.LogRecord) -> bool:
+    """Log filter that holds back the records from worker threads that are collecting them, so the output of each chunk is not mixed together with the others."""
+    records = getattr(workerClients, 'records', None)
+    if records is None:
+        return True
+    records.append(record)
+    return False
+
+class LevelFormatter(logging.Formatter):
+    """Format records with the level prefix the old print calls used, a colon after the level like 'INFO: ...' except for records logged with
+    extra={'inline': True} whose message reads on from the level, like 'ERROR 403 from Google API while ...'.
+    """
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.separator = '' if getattr(record, 'inline', False) else ':'
+        return super().formatMessage(record)
+
+class JsonFormatter(logging.Formatter):
+    """Format each log record as one line of JSON with its time, level and message, plus any structured fields passed in with extra={'fields': {...}}."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(), 'level': record.levelname, 'message': f'{record.levelname} {message}' if getattr(record, 'inline', False) else message}
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+def start_logging(schoolMode: any, runType: str, jsonLog: bool = False) -> QueueListener:
+    """Send everything logged to a queue, and start a background thread that writes it to the console and the log files so the sync never waits on them.
+
+    Each school mode and run type gets its own log files, so the frequent delta runs do not rotate out the log of the last full run. They are rolled over
+    at the start of each run, so LOG_FILE always has the latest run and the previous LOG_BACKUP_COUNT runs are kept.
+    """
+    consoleHandler = logging.StreamHandler(sys.stdout)
+    consoleHandler.setLevel(CONSOLE_LOG_LEVEL)
+    consoleHandler.setFormatter(LevelFormatter(LOG_FORMAT))
+    handlers = [consoleHandler]
+    logFiles = [(LOG_FILE, LevelFormatter(LOG_FORMAT)), (JSON_LOG_FILE, JsonFormatter())] if jsonLog else [(LOG_FILE, LevelFormatter(LOG_FORMAT))]
+    rolloverErrors = []
+    for path, formatter in logFiles:
+        path = path.format(school_mode=schoolMode, run_type=runType)
+        fileHandler = RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, delay=True)
+        if os.path.exists(path) and os.path.getsize(path) > 0:  # start each run in a fresh file instead of truncating the last one
+            try:
+                fileHandler.doRollover()
+            except OSError as er:  # on Windows the file cannot be renamed while another run has it open, so just add on to the end of it instead
+                rolloverErrors.append(f'Could not roll over {path}, this run will be added to the end of it: {er}')
+        fileHandler.setLevel(LOG_LEVEL)
+        fileHandler.setFormatter(formatter)
+        handlers.append(fileHandler)
+
+    logQueue = SimpleQueue()
+    queueHandler = QueueHandler(logQueue)
+    queueHandler.addFilter(hold_worker_records)
+    logger.addHandler(queueHandler)
+    logger.setLevel(min(LOG_LEVEL, CONSOLE_LOG_LEVEL))  # anything below both levels is dropped before the message is even built
+    logger.propagate = False
+    listener = QueueListener(logQueue, *handlers, respect_handler_level=True)
+    listener.start()
+    for message in rolloverErrors:
+        logger.warning(message)
+    return listener
+
+def stop_logging(listener: QueueListener) -> None:
+    """Write out everything still in the queue, then close the log files and detach the queue from the logger."""
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+def sync_students(school_mode: any, workers: int = 1, delta: bool = False, full_reconcile: bool = False, dry_run: bool = False, json_log: bool = False, resume: bool = False) -> None:
+    """Main function to sync students, needs to be called with 'full', 'limited', or a specific school number.
+
+    Pass workers greater than 1 to process the buildings in parallel, split into chunks of PARALLEL_CHUNK_SIZE students.
+    Pass delta=True to only process students whose PowerSchool data changed since the last run, unless full_reconcile is True or it has been FULL_RECONCILE_HOURS since the last full run.
+    Pass dry_run=True to output the full plan of changes without sending any writes to Google.
+    Pass json_log=True to also write the log with its structured fields to JSON_LOG_FILE. Delta runs log to their own files, separate from the full runs of the same school mode.
+    Pass resume=True to skip the buildings and students that the last run of this school mode got through before it crashed, based on its CHECKPOINT_FILE entry.
+    """
+    listener = start_logging(school_mode, 'delta' if delta else 'full', json_log)
+    try:
+        phaseTimer.reset()
+        metrics.reset()
         startDate = datetime.now()
         startTime = startDate.strftime('%H:%M:%S')
-        print(f'Execution started at {startTime}')
-        print(f'Execution started at {startTime}', file=log)
-
-        # Get credentials from json file, ask for permissions on scope or use existing token.json approval, then build the "service" connection to Google API
-        creds = None
-            # The file token.json stores the user's access and refresh tokens, and is
-            # created automatically when the authorization flow completes for the first
-            # time.
-        if os.path.exists('token.json'):
-            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-        # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-                creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open('token.json', 'w') as token:
-                token.write(creds.to_json())
+        logger.info(f'Execution started at {startTime}')
+        if dry_run:
+            logger.info('Running in dry run mode, changes will be output but not made in Google')
 
+        # get the credentials then build the "service" connection to Google API
+        creds = get_credentials()
         service = build('admin', 'directory_v1', credentials=creds)
         licenseService = build('licensing', 'v1', credentials=creds)
+        limiter = RateLimiter(GOOGLE_REQUESTS_PER_SECOND)  # one limiter for every Google API call, shared by all the workers in parallel mode so together they stay under the quota
 
-        # define a custom exception class just for use with logging
-        class BadNameExceptionError(Exception):
-            pass
+        state = SyncState()  # open the snapshot of what was synced last time, every run updates it so the delta mode can be switched on at any point
+        fullRun = not delta or full_reconcile or state.reconcile_due(school_mode)  # whether every student should be processed, or just the changed ones
+        if fullRun:
+            # get every user in the domain at once and store them in a dict, so we can look each student up locally instead of one query per student
+            with phaseTimer.time('google_lookup'):
+                googleUsers = get_google_users(service, limiter)
+        else:
+            snapshot = state.load()
+            googleUsers = {}  # filled in building by building with just the students that changed
+            logger.info(f'Running in delta mode, only students changed since the last sync will be processed. {len(snapshot)} students in the snapshot')
+
+        # during the summer graduates get their license removed, so get everyone who still has it to avoid sending removals for people who do not
+        licensedUsers = None
+        if GRADUATED_ACTIVE_SUMMER and startDate.month in [6, 7, 8]:
+            with phaseTimer.time('google_lookup'):
+                licensedUsers = get_licensed_users(licenseService, limiter)
+        groupCache = GroupCache(limiter)  # only gets filled in if enough users are suspended in this run
+
+        checkpoint = Checkpoint(school_mode)  # progress is saved after each batch so a crashed run can be resumed
+        resumeFrom = checkpoint.load() if resume else None
+        if resumeFrom:
+            logger.info(f'Resuming the last run, skipping everything up to student {resumeFrom[1]} in building {resumeFrom[0]}')
+        elif resume:
+            logger.info(f'No checkpoint found for {school_mode}, processing every building')
+        pendingGroupRemovals = checkpoint.load_suspending()  # students suspended by an earlier run that never got removed from their groups
+        if pendingGroupRemovals:
+            logger.info(f'{len(pendingGroupRemovals)} students were suspended by an unfinished run and still need to be removed from their groups')
+        writeCheckpoint = None if dry_run else checkpoint  # a dry run does not suspend anyone so it should not touch the list
+        runType = 'resumed' if resumeFrom else 'full' if fullRun else 'delta'  # kept apart in the metrics files since their student counts are not comparable
+
+        def commit(school: tuple, synced: list, lastStudent: tuple) -> None:
+            """Save the students that were just sent to Google to the SyncState, and move the checkpoint past them."""
+            state.record(synced, startDate)
+            checkpoint.save(school[1], lastStudent[0])
 
         with oracledb.connect(user=DB_UN, password=DB_PW, dsn=DB_CS) as con:  # create the connecton to the database
             with con.cursor() as cur:  # start an entry cursor
-                print(f'INFO: Connection established to PS database on version: {con.version}')
-                print(f'INFO: Connection established to PS database on version: {con.version}', file=log)
-
-                # Start by getting a list of schools from the schools table view to get the school names, numbers, etc for use. If the mode is "full" we want all schools, if not we only want the main schools not excluded from state reporting
-                if school_mode == 'full':  # do every school in PS
-                    cur.execute('SELECT name, school_number, abbreviation FROM schools ORDER BY school_number')
-                elif school_mode == 'limited':  # do only schools that would be in state reporting, aka "real" schools, not the graduated students, pre-registered, etc
-                    cur.execute('SELECT name, school_number, abbreviation FROM schools WHERE State_ExcludeFromReporting = 0 ORDER BY school_number')
-                else:  # otherwise do the specific school number that it could be called with
-                    cur.execute('SELECT name, school_number, abbreviation FROM schools WHERE school_number = :school ORDER BY school_number', school = school_mode)
-
-                schools = cur.fetchall()  # store all the query results in the schools list
-                for school in schools:
-                    # store results in variables mostly just for readability
-                    schoolName = school[0].title()  # convert to title case since some are all caps
-                    schoolNum = school[1]
-                    schoolAbbrev = school[2]
-                    # construct the string for the organization unit in Google Admin from the building name + students
-                    orgUnit = OU_PREFIX + schoolAbbrev + ' Students'
-                    if schoolName == GRADUATED_SCHOOL_NAME:  # check and see if our building is the graduated students building or enroll status is graduated since they have a different OU then the rest
-                        orgUnit = GRADUATED_OU
-                    print(f'DBUG: Starting Building: {schoolName} | {schoolNum} | {orgUnit}')  # debug
-                    print(f'DBUG: Starting Building: {schoolName} | {schoolNum} | {orgUnit}',file=log)  # debug
-
-                    # query for all students in the curent school
-                    cur.execute('SELECT student_number, first_name, last_name, classof, enroll_status, schoolid, grade_level FROM students WHERE schoolid = :school ORDER BY student_number DESC', school=schoolNum)
-                    students = cur.fetchall()
-                    for student in students:
+                logger.info(f'Connection established to PS database on version: {con.version}')
+
+                def get_students(school: tuple, students):
+                    """In delta mode narrow the students of a building down to the changed ones and look up just their Google accounts, otherwise return them as is."""
+                    students = phaseTimer.timed('db_fetch', students)  # the rows are streamed from the cursor as they are used, so time each one
+                    if fullRun:
+                        return students
+                    students = get_changed_students(students, snapshot)
+                    logger.debug('%s students in building %s changed since the last sync', len(students), school[1])
+                    foundUsers, lookupFailed = get_google_users_by_email(service, [str(int(student[0])) + EMAIL_SUFFIX for student in students], limiter)
+                    googleUsers.update(foundUsers)
+                    return [student for student in students if str(int(student[0])) + EMAIL_SUFFIX not in lookupFailed]  # skip anyone we could not look up, otherwise we would try to create them again
+
+                buildings = phaseTimer.timed('db_fetch', get_buildings(cur, school_mode))
+                if resumeFrom:
+                    buildings = skip_completed(buildings, resumeFrom)
+                completed = True  # set to False if a chunk in parallel mode did not finish, so the run is not treated as a clean completion
+                if workers > 1:
+                    logger.info(f'Processing buildings in parallel with {workers} workers')
+                    with ThreadPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(creds,)) as pool:
+                        chunks = []  # (future, school, last student) of each chunk in the order they were submitted, which is the order the checkpoint moves through them
+                        pending = set()  # futures of the chunks that have not been collected yet
+                        finishedChunks = set()
+                        nextChunk = 0  # index of the first chunk that has not finished, the checkpoint can only move up to the chunk before it
+
+                        def collect(future) -> bool:
+                            """Write a chunk to the log as its own section, save its students to the SyncState and move the checkpoint past any chunks that are done. Returns whether the chunk finished."""
+                            nonlocal nextChunk
+                            pending.discard(future)
+                            records, synced, finished = future.result()
+                            for record in records:
+                                logger.handle(record)
+                            state.record(synced, startDate)
+                            if finished:
+                                finishedChunks.add(future)
+                            if not dry_run and nextChunk < len(chunks) and chunks[nextChunk][0] in finishedChunks:
+                                while nextChunk < len(chunks) and chunks[nextChunk][0] in finishedChunks:
+                                    nextChunk += 1
+                                checkpoint.save(chunks[nextChunk - 1][1][1], chunks[nextChunk - 1][2][0])
+                            return finished
+
                         try:
-                            bodyDict = {}  # define empty dict that will hold the update parameters
-                            # print(student)
-                            # print(student, file=log)
-                            stuNum = int(student[0])
-                            firstName = str(student[1]).title()
-                            lastName = str(student[2]).title()
-                            if firstName.lower() in BAD_NAMES or lastName.lower() in BAD_NAMES:  # check their first and last names against the list of test/dummy accounts
-                                raise BadNameExceptionError('Found name that matches list of bad names')  # raise an exception for them if they have a bad name, which skips the rest of processing
-                            email = str(stuNum) + EMAIL_SUFFIX
-                            gradYear = int(student[3])
-                            enroll = int(student[4])
-                            school = int(student[5])
-                            grade = int(student[6])
-
-                            currentYear = int(startDate.strftime("%Y"))  # get the current year as a integer from the start time
-                            currentMonth = startDate.strftime("%B")  # get the current month name as a string
-
-                            suspended = False if enroll == 0 or enroll == -1 else True  # create a flag for whether they should be suspended or not, will be based on their enroll status
-                            # override graduated students being suspended for the months of july and august so they can still access their emails until september 1st
-                            if gradYear == currentYear and GRADUATED_ACTIVE_SUMMER:  # check current year against grad year
-                                if currentMonth == "June" or currentMonth == "July" or currentMonth == "August":  # check if it is currently July or August
-                                    if schoolName == GRADUATED_SCHOOL_NAME and enroll == 3:  # make sure the student is in the graduated students building and status of graduated
-                                        suspended = False
-                                        print(f'WARN: {email} is a {currentYear} graduate, they will remain active until September 1st')
-                                        print(f'WARN: {email} is a {currentYear} graduate, they will remain active until September 1st', file=log)
-                                        # remove their license as my other script only removes them once they are suspended, but that overlaps with new school year licensing
-                                        try:
-                                            print(f'INFO: Removing license {LICENSE_PRODUCT_ID} - {LICENSE_SKU} from graduated student {email}')
-                                            print(f'INFO: Removing license {LICENSE_PRODUCT_ID} - {LICENSE_SKU} from graduated student {email}', file=log)
-                                            licenseService.licenseAssignments().delete(productId=LICENSE_PRODUCT_ID, skuId=LICENSE_SKU, userId=email).execute()  # does the actual removal of the license
-                                        except HttpError as er:   # catch Google API http errors, get the specific message and reason from them for better logging
-                                            status = er.status_code
-                                            details = er.error_details[0]  # error_details returns a list with a dict inside of it, just strip it to the first dict
-                                            print(f'ERROR {status} from Google API while removing license from graduated student {email}: {details["message"]}. Reason: {details["reason"]}')
-                                            print(f'ERROR {status} from Google API while removing license from graduated student {email}: {details["message"]}. Reason: {details["reason"]}', file=log)
-                                        except Exception as er:
-                                            print(f'ERROR while removing license from graduated student {email}: {er}')
-                                            print(f'ERROR while removing license from graduated student {email}: {er}', file=log)
-
-
-                            # set the OU path based on their school, grades, enroll status, etc
-                            properOU = orgUnit + GRADE_OUS.get(grade)  # for enabled accounts at normal buildings, they get the overall building OU + the grade level sub-OU
-                            # have a section to set OU for pre registered and graduated students separately as it does not include any grade sub-ous
-                            if school == 999999 or enroll == 3 or school == 901 or enroll == -1:
-                                properOU = orgUnit
-                            # if they are just suspended (but not graduated), they get the normal suspended OU
-                            if suspended and (school != 999999 and enroll != 3):
-                                properOU = SUSPENDED_OU
-
-
-                            print(f'DBUG: User {email}, Name: {firstName} {lastName}, school: {school}, grade: {grade}, graduation year: {gradYear}, enroll: {enroll}, suspended: {suspended}, OU path: {properOU}')
-                            print(f'DBUG: User {email}, Name: {firstName} {lastName}, school: {school}, grade: {grade}, graduation year: {gradYear}, enroll: {enroll}, suspended: {suspended}, OU path: {properOU}', file=log)
-
-                            # next do a query in Google Admin for the students account based on their email
-                            queryString = 'email=' + email  # construct the query string which looks for the email
-                            userToUpdate = service.users().list(customer='my_customer', domain=GOOGLE_DOMAIN, maxResults=2, orderBy='email', projection='full', query=queryString).execute()  # return a list of at most 2 users
-
-                            # process all the active students
-                            if not suspended:
-                                # print('enabled')
-                                # print('enabled', file=log)
-                                if userToUpdate.get('users'):  # if we found a user in Google that matches the user email, they already exist and we just want to update any info
-                                    frozen = False  # define a flag for whether they are in a frozen OU, set to false initially
-
-                                    # get info from their account
-                                    currentlySuspended = userToUpdate.get('users')[0].get('suspended')
-                                    currentOU = userToUpdate.get('users')[0].get('orgUnitPath')
-                                    # print(f'DBUG: Student {email} already has an existing Google account, updating any info')
-                                    # print(f'DBUG: Student {email} already has an existing Google account, updating any info', file=log)
-
-                                    # check to see if the user is enabled in Google, if not add that to the update body
-                                    if currentlySuspended == True:
-                                        bodyDict.update({'suspended': False})
-
-                                    # Check to see if they are in the correct OU (which is based on home building assignment)
-                                    if currentOU != properOU:
-                                        for org in FROZEN_OUS:  # go through our list of "frozen" OU paths which contain a few users with custom settings, licenses, etc
-                                            if org in currentOU:  # check and see if the frozen OU path is part of the OU they are currently in, if so set the frozen flag to True
-                                                frozen = True
-                                        if frozen:  # if they are in a frozen OU we do not add the change, but just print out an info line for logging
-                                            print(f'WARN: User {email} is in the frozen OU {currentOU} and will not be moved to {properOU}')
-                                            print(f'WARN: User {email} is in the frozen OU {currentOU} and will not be moved to {properOU}', file=log)
-                                        else:  # if theyre not in a frozen OU they will have the orgunit change added to the body of the update
-                                            print(f'INFO: User {email} not in a frozen OU, will to be moved from {currentOU} to {properOU}')
-                                            print(f'INFO: User {email} not in a frozen OU, will to be moved from {currentOU} to {properOU}', file=log)
-                                            bodyDict.update({'orgUnitPath' : properOU})  # add OU to body of the update
-
-                                    # Check to see if the student's name has changed significantly, if so update the name in Google
-                                    currentFirstName = userToUpdate.get('users')[0].get('name').get('givenName')
-                                    currentLastName = userToUpdate.get('users')[0].get('name').get('familyName')
-                                    if currentFirstName.upper() != firstName.upper():
-                                        print(f'INFO: User {email} has changed first name from {currentFirstName} to {firstName}, updating')
-                                        print(f'INFO: User {email} has changed first name from {currentFirstName} to {firstName}, updating', file=log)
-                                        bodyDict.update({'name' : {'givenName' : firstName}})
-                                    if currentLastName.upper() != lastName.upper():
-                                        print(f'INFO: User {email} has changed last name from {currentLastName} to {lastName}, updating')
-                                        print(f'INFO: User {email} has changed last name from {currentLastName} to {lastName}, updating', file=log)
-                                        bodyDict.update({'name' : {'familyName' : lastName}})
-
-                                    # get custom attributes info from their google profile
-                                    try:  # put the retrieval of the custom data in a try/except block because some accounts might not have the data, which will then need to be added
-                                        currentSchool = int(userToUpdate.get('users')[0].get('customSchemas').get(CUSTOM_ATTRIBUTE_CATEGORY).get(CUSTOM_ATTRIBUTE_SCHOOL))  # take the first user's custom schema homeschool id and store it
-                                        currentGrad = int(userToUpdate.get('users')[0].get('customSchemas').get(CUSTOM_ATTRIBUTE_CATEGORY).get(CUSTOM_ATTRIBUTE_GRADYEAR))  # take the first user's custom schema graduation year and store it
-                                        if (currentSchool != school or currentGrad != gradYear):
-                                            print(f'INFO: Updating {email}. School from {currentSchool} to {school}, Graduation Year from {currentGrad} to {gradYear}')
-                                            print(f'INFO: Updating {email}. School from {currentSchool} to {school}, Graduation Year from {currentGrad} to {gradYear}', file=log)
-                                            bodyDict.update({'customSchemas' : {CUSTOM_ATTRIBUTE_CATEGORY : {CUSTOM_ATTRIBUTE_SCHOOL : school, CUSTOM_ATTRIBUTE_GRADYEAR : gradYear}}})
-                                    except Exception as er:
-                                        print(f'ERROR: User {email} had no or was missing Synchronization_Data, it will be created: ({er})')
-                                        print(f'ERROR: User {email} had no or was missing Synchronization_Data, it will be created: ({er})', file=log)
-                                        # Since the error was probably not having any synchronization data for whatever reason, it should be added to the body of the update
-                                        print(f'INFO: Updating {email}. School to {school}, Graduation Year to {gradYear}')
-                                        print(f'INFO: Updating {email}. School to {school}, Graduation Year to {gradYear}', file=log)
-                                        bodyDict.update({'customSchemas' : {CUSTOM_ATTRIBUTE_CATEGORY : {CUSTOM_ATTRIBUTE_SCHOOL : school, CUSTOM_ATTRIBUTE_GRADYEAR : gradYear}}})
-
-                                    # Finally, do the actual update of the user profile, using the bodyDict we have constructed in the above sections
-                                    if bodyDict:  # if there is anything in the body dict we want to update. if its empty we skip the update
-                                        try:
-                                            print(bodyDict)  # debug
-                                            print(bodyDict, file=log)  # debug
-                                            outcome = service.users().update(userKey = email, body=bodyDict).execute()  # does the actual updating of the user profile
-                                            # print(outcome, file=log)  # debug, should return the update json body
-                                        except Exception as er:
-                                            print(f'ERROR: cannot update {email} : {er}')
-                                            print(f'ERROR: cannot update {email} : {er}', file=log)
-                                # if there is no google result for our email query, we should try to create a new email account
-                                else:
-                                    print(f'INFO: User {email} does not exist, will be created')
-                                    print(f'INFO: User {email} does not exist, will be created', file=log)
-                                    try:
-                                        # define the new user email, name, and all the basic fields
-                                        newUser = {'primaryEmail' : email, 'name' : {'givenName' : firstName, 'familyName' : lastName}, 'password' : NEW_PASSWORD, 'changePasswordAtNextLogin' : True, 'orgUnitPath' : properOU,
-                                                'customSchemas' : {CUSTOM_ATTRIBUTE_CATEGORY : {CUSTOM_ATTRIBUTE_SCHOOL : school, CUSTOM_ATTRIBUTE_GRADYEAR : gradYear}}}
-                                        outcome = service.users().insert(body=newUser).execute()  # does the actual account creation
-                                        # print(outcome, file=log)  # debug, should return the update json body
-                                    except Exception as er:
-                                        print(f'ERROR on user account creation for {email}: {er}')
-                                        print(f'ERROR on user account creation for {email}: {er}', file=log)
-
-                            # process all the inactive students
-                            else:
-                                # print(f'DBUG: User {email} is inactive, should be suspended')
-                                # print(f'DBUG: User {email} is inactive, should be suspended', file=log)
-                                if userToUpdate.get('users'):  # if we found a user in Google that matches the user email, they already exist and we just want to update any info
-                                    # get info from their account
-                                    currentlySuspended = userToUpdate.get('users')[0].get('suspended')
-                                    currentOU = userToUpdate.get('users')[0].get('orgUnitPath')
-                                    if not currentlySuspended:
-                                        print(f'INFO: Suspending {email}')
-                                        print(f'INFO: Suspending {email}', file=log)
-                                        bodyDict.update({'suspended' : True})  # add the suspended: True to the body of the update patch
-                                    if currentOU != properOU:
-                                        print(f'INFO: Moving {email} to suspended OU {properOU}')
-                                        print(f'INFO: Moving {email} to suspended OU {properOU}', file=log)
-                                        bodyDict.update({'orgUnitPath' : properOU})  # add the suspended OU to the org unit path for the update patch
-
-                                    # finally do the update (suspend and move) if we have anything in the bodyDict
-                                    if bodyDict:
-                                        print(bodyDict)
-                                        print(bodyDict, file=log)
-                                        outcome = service.users().update(userKey = email, body=bodyDict).execute()  # does the actual updating of the user profile  # noqa: F841
-                                        # print(outcome, file=log)  # debug, should return the update json body
-                                        # Remove the newly suspended user from any groups they were a member of
-                                        userGroups = service.groups().list(userKey=email).execute().get('groups')  # get the current groups the user is in
-                                        if userGroups:
-                                            for group in userGroups:  # if they have groups they are still a member of, go through each group and remove them
-                                                name = group.get('name')
-                                                groupEmail = group.get('email')
-                                                print(f'{email} was a member of: {name} - {groupEmail}, they will be removed from the group')
-                                                print(f'{email} was a member of: {name} - {groupEmail}, they will be removed from the group',file=log)
-                                                service.members().delete(groupKey=groupEmail, memberKey=email).execute()
-                                        else:
-                                            print(f'DBUG: Newly suspended account {email} was not in any groups, no removal needed')
-                                            print(f'DBUG: Newly suspended account {email} was not in any groups, no removal needed', file=log)
-                                    # else:  # handles if they were already suspended and no change needed
-                                        # print(f'DBUG: {email} is already suspended in the correct suspended accounts OU, no update needed')
-                                        # print(f'DBUG: {email} is already suspended in the correct suspended accounts OU, no update needed', file=log)
-                                # else:  # if we did not find any google accounts matching the email, just give a warning
-                                    # print(f'DBUG: Found inactive student {email} without Google account that matches.')
-                                    # print(f'DBUG: Found inactive student {email} without Google account that matches.', file=log)
-
-                        except BadNameExceptionError:
-                            print(f'WARN: found user matching name in bad names list {email} - {firstName} {lastName}')
-                            print(f'WARN: found user matching name in bad names list {email} - {firstName} {lastName}', file=log)
-                        except HttpError as er:   # catch Google API http errors, get the specific message and reason from them for better logging
-                            status = er.status_code
-                            details = er.error_details[0]  # error_details returns a list with a dict inside of it, just strip it to the first dict
-                            print(f'ERROR {status} from Google API while processing student {student[0]}: {details["message"]}. Reason: {details["reason"]}')
-                            print(f'ERROR {status} from Google API while processing student {student[0]}: {details["message"]}. Reason: {details["reason"]}', file=log)
-                        except Exception as er:
-                            print(f'ERROR while processing student {student[0]}: {er}')
-                            print(f'ERROR while processing student {student[0]}: {er}', file=log)
-
-        endTime = datetime.now()
-        endTime = endTime.strftime('%H:%M:%S')
-        print(f'Execution ended at {endTime}')
-        print(f'Execution ended at {endTime}', file=log)
+                            for school, students in buildings:
+                                # split the students of the building into chunks so big buildings are spread across the workers
+                                students = iter(get_students(school, students))
+                                chunk = list(islice(students, PARALLEL_CHUNK_SIZE))
+                                while chunk:
+                                    future = pool.submit(sync_building_worker, school, chunk, googleUsers, startDate, limiter, dry_run, licensedUsers, groupCache, pendingGroupRemovals, writeCheckpoint)
+                                    chunks.append((future, school, chunk[-1]))
+                                    pending.add(future)
+                                    for doneFuture in [doneFuture for doneFuture in pending if doneFuture.done()]:  # save the chunks that already finished while the rest of the rows are still streaming
+                                        completed = collect(doneFuture) and completed
+                                    chunk = list(islice(students, PARALLEL_CHUNK_SIZE))
+                        finally:
+                            for future in as_completed(list(pending)):  # wait for the rest, even if the rows stopped partway through, so the chunks that were already sent are still saved
+                                completed = collect(future) and completed
+                else:
+                    for school, students in buildings:  # the students are streamed from the database straight into the sync
+                        sync_building(school, get_students(school, students), googleUsers, service, licenseService, startDate, limiter, dry_run, licensedUsers, groupCache,
+                                      onCommit=lambda synced, lastStudent, school=school: commit(school, synced, lastStudent), pendingGroupRemovals=pendingGroupRemovals, checkpoint=writeCheckpoint)
+
+        if not completed:
+            logger.warning('Not every chunk finished, keeping the checkpoint so the run can be resumed')
+        if fullRun and not dry_run and completed:
+            state.set_full_reconcile(school_mode, startDate)
+        state.close()
+        if not dry_run and completed:
+            checkpoint.clear()  # the run made it all the way through, so the next one should start from the beginning
+        metrics.write_summary()  # output the per-endpoint and per-building counters
+        limiter.write_summary()
+
+        endDate = datetime.now()
+        phaseTimer.write_summary((endDate - startDate).total_seconds())
+        if not dry_run:  # a dry run does not send any writes so its numbers would throw off the dashboards
+            metrics.write_files(school_mode, runType, startDate, (endDate - startDate).total_seconds(), phaseTimer.seconds)
+        endTime = endDate.strftime('%H:%M:%S')
+        logger.info(f'Execution ended at {endTime}')
+    finally:
+        stop_logging(listener)
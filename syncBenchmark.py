@@ -0,0 +1,432 @@
+"""Offline benchmark for the main studentsync.py script, so sync throughput can be measured without touching the production Google or PowerSchool.
+
+Swaps in a fake oracledb module that generates a synthetic set of students across schools, grades and enroll statuses, and a fake
+googleapiclient with users, groups, members and licenseAssignments resources that can add latency and inject 403/429 errors.
+Then runs sync_students for each mode and reports the students per second, API calls per student and peak memory.
+
+Example: python syncBenchmark.py --students 140000 --latency 0.05 --error-rate 0.01
+"""
+
+import argparse  # needed to read the command line arguments
+import contextlib  # needed to hide the console output of the sync while it runs
+import os  # needed to run the sync in a temp directory
+import random  # needed to generate the synthetic data and errors
+import sys  # needed to install the fake modules
+import tempfile  # needed to run the sync in a temp directory so the log and state files do not overwrite real ones
+import threading  # needed for the lock around the call counters since the parallel mode uses multiple threads
+import time  # needed for the timing and fake latency
+import tracemalloc  # needed to measure the peak memory
+import types  # needed to build the fake modules
+
+# synthetic schools as (name, school_number, abbreviation, State_ExcludeFromReporting), the excluded ones are only processed by the full mode
+BENCHMARK_SCHOOLS = [('Elementary One', 1, 'EO', 0), ('Elementary Two', 2, 'ET', 0), ('Elementary Three', 3, 'EH', 0), ('Middle School', 4, 'MS', 0),
+                     ('High School', 5, 'HS', 0), ('Pre-Registration', 901, 'PRE', 1), ('Graduated Students', 999999, 'GRAD', 1)]
+LIMITED_SHARE = 0.06  # share of the synthetic students that are placed in the state reporting schools, roughly our 8000 of 140000
+EXISTING_ACCOUNT_SHARE = 0.9  # share of the synthetic students that already have a Google account
+DRIFT_SHARE = 0.05  # share of the existing accounts that have something different from PowerSchool and need an update
+ALIAS_SHARE = 0.02  # share of the existing accounts that were renamed, so the student number email is only an alias of the account
+BAD_NAME_SHARE = 0.005  # extra rows added on top of the students for dummy accounts named after the BAD_NAMES list, which the query should filter out
+
+
+class FakeHttpError(Exception):
+    """Stand in for googleapiclient.errors.HttpError with the same status_code, reason and error_details attributes."""
+
+    def __init__(self, status: int, reason: str, message: str):
+        super().__init__(message)
+        self.status_code = status
+        self.reason = reason
+        self.error_details = [{'message': message, 'reason': reason}]
+        self.resp = types.SimpleNamespace(status=status, reason=reason)
+
+
+class FakeGoogle:
+    """In memory Google directory and license data along with the counters for the calls made against it."""
+
+    def __init__(self, latency: float, errorRate: float):
+        self.latency = latency  # seconds each HTTP round trip takes
+        self.errorRate = errorRate  # share of requests that come back with a quota error
+        self.users = {}
+        self.aliases = {}  # alias email to the primary email of the account it belongs to
+        self.groups = {}  # email to list of group dicts the user is a member of
+        self.licenses = set()  # emails that hold the license
+        self.calls = {}  # endpoint name to the number of requests made to it
+        self.roundTrips = 0  # number of actual HTTP round trips, a batch only counts once
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(2)
+
+    def resolve(self, userKey: str) -> str:
+        """Turn a userKey that may be an alias into the primary email, the same way the real API accepts either."""
+        return self.aliases.get(userKey, userKey)
+
+    def count(self, endpoint: str) -> None:
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def round_trip(self) -> None:
+        with self.lock:
+            self.roundTrips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def maybe_error(self) -> None:
+        """Randomly raise a quota error, the same way the real API does when going too fast."""
+        if self.errorRate:
+            with self.lock:
+                roll = self.random.random()
+            if roll < self.errorRate:
+                with self.lock:
+                    self.errors += 1
+                if roll < self.errorRate / 2:
+                    raise FakeHttpError(403, 'userRateLimitExceeded', 'Quota exceeded for quota metric')
+                raise FakeHttpError(429, 'rateLimitExceeded', 'Rate Limit Exceeded')
+
+
+class FakeRequest:
+    """Stand in for googleapiclient.http.HttpRequest, the work is done by the function when it is executed."""
+
+    def __init__(self, google: FakeGoogle, endpoint: str, function):
+        self.google = google
+        self.endpoint = endpoint
+        self.methodId = ('licensing.' if endpoint.startswith('license') else 'directory.') + endpoint  # same format as the real requests, like directory.users.update
+        self.function = function
+
+    def run(self):
+        """Run the request without the round trip latency, used by both execute and the batches."""
+        self.google.count(self.endpoint)
+        self.google.maybe_error()
+        return self.function()
+
+    def execute(self, num_retries: int = 0):
+        self.google.round_trip()
+        return self.run()
+
+
+class FakeBatch:
+    """Stand in for googleapiclient.http.BatchHttpRequest, sends every request in one round trip and calls each callback."""
+
+    def __init__(self, google: FakeGoogle, callback=None):
+        self.google = google
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request: FakeRequest, callback=None, request_id: str = None) -> None:
+        if len(self.requests) >= 1000:
+            raise Exception('Exceeded maximum calls (1000) in a single batch request.')
+        self.requests.append((request, callback or self.callback, request_id or str(len(self.requests))))
+
+    def execute(self) -> None:
+        self.google.round_trip()
+        for request, callback, requestId in self.requests:
+            try:
+                response = request.run()
+            except FakeHttpError as er:
+                callback(requestId, None, er)
+            else:
+                callback(requestId, response, None)
+
+
+def page(items: list, key: str, pageToken: str, maxResults: int) -> dict:
+    """Return one page of a list call, the page token is just the index the next page starts at."""
+    start = int(pageToken or 0)
+    results = {key: items[start:start + maxResults]}
+    if start + maxResults < len(items):
+        results['nextPageToken'] = str(start + maxResults)
+    return results
+
+
+class FakeUsers:
+    """Stand in for the users() resource of the Directory API."""
+
+    def __init__(self, google: FakeGoogle):
+        self.google = google
+
+    def list(self, customer=None, domain=None, maxResults=100, projection=None, fields=None, pageToken=None, **kwargs) -> FakeRequest:
+        def list_users():
+            return page([dict(self.google.users[email]) for email in sorted(self.google.users)], 'users', pageToken, maxResults)
+        return FakeRequest(self.google, 'users.list', list_users)
+
+    def get(self, userKey, **kwargs) -> FakeRequest:
+        def get_user():
+            email = self.google.resolve(userKey)
+            if email not in self.google.users:
+                raise FakeHttpError(404, 'notFound', 'Resource Not Found: userKey')
+            return dict(self.google.users[email])
+        return FakeRequest(self.google, 'users.get', get_user)
+
+    def update(self, userKey, body) -> FakeRequest:
+        def update_user():
+            email = self.google.resolve(userKey)
+            if email not in self.google.users:
+                raise FakeHttpError(404, 'notFound', 'Resource Not Found: userKey')
+            user = self.google.users[email]
+            for key, value in body.items():  # nested fields like name are merged the same way the real API does instead of replaced
+                user[key] = {**user[key], **value} if isinstance(value, dict) and isinstance(user.get(key), dict) else value
+            return dict(user)
+        return FakeRequest(self.google, 'users.update', update_user)
+
+    def insert(self, body) -> FakeRequest:
+        def insert_user():
+            if self.google.resolve(body['primaryEmail']) in self.google.users:
+                raise FakeHttpError(409, 'duplicate', 'Entity already exists.')
+            self.google.users[body['primaryEmail']] = dict(body)
+            return dict(body)
+        return FakeRequest(self.google, 'users.insert', insert_user)
+
+
+class FakeGroups:
+    """Stand in for the groups() resource of the Directory API."""
+
+    def __init__(self, google: FakeGoogle):
+        self.google = google
+
+    def list(self, userKey=None, customer=None, maxResults=200, pageToken=None, **kwargs) -> FakeRequest:
+        def list_groups():
+            if userKey:
+                return {'groups': list(self.google.groups.get(self.google.resolve(userKey), []))}
+            groups = {group['email']: group for userGroups in self.google.groups.values() for group in userGroups}  # every group in the domain
+            return page([dict(groups[email]) for email in sorted(groups)], 'groups', pageToken, maxResults)
+        return FakeRequest(self.google, 'groups.list', list_groups)
+
+
+class FakeMembers:
+    """Stand in for the members() resource of the Directory API."""
+
+    def __init__(self, google: FakeGoogle):
+        self.google = google
+
+    def list(self, groupKey, maxResults=200, pageToken=None, **kwargs) -> FakeRequest:
+        def list_members():
+            members = sorted(email for email, groups in self.google.groups.items() if any(group['email'] == groupKey for group in groups))
+            return page([{'email': email} for email in members], 'members', pageToken, maxResults)
+        return FakeRequest(self.google, 'members.list', list_members)
+
+    def delete(self, groupKey, memberKey) -> FakeRequest:
+        def delete_member():
+            email = self.google.resolve(memberKey)
+            self.google.groups[email] = [group for group in self.google.groups.get(email, []) if group['email'] != groupKey]
+            return ''
+        return FakeRequest(self.google, 'members.delete', delete_member)
+
+
+class FakeLicenseAssignments:
+    """Stand in for the licenseAssignments() resource of the Licensing API."""
+
+    def __init__(self, google: FakeGoogle):
+        self.google = google
+
+    def listForProductAndSku(self, productId, skuId, customerId, maxResults=100, pageToken=None, **kwargs) -> FakeRequest:
+        def list_licenses():
+            return page([{'userId': email} for email in sorted(self.google.licenses)], 'items', pageToken, maxResults)
+        return FakeRequest(self.google, 'licenseAssignments.listForProductAndSku', list_licenses)
+
+    def delete(self, productId, skuId, userId) -> FakeRequest:
+        def delete_license():
+            if userId not in self.google.licenses:
+                raise FakeHttpError(404, 'notFound', 'User does not have a license for specified sku and product')
+            self.google.licenses.discard(userId)
+            return ''
+        return FakeRequest(self.google, 'licenseAssignments.delete', delete_license)
+
+
+class FakeService:
+    """Stand in for the service object returned by googleapiclient.discovery.build."""
+
+    def __init__(self, google: FakeGoogle):
+        self.google = google
+
+    def users(self) -> FakeUsers:
+        return FakeUsers(self.google)
+
+    def groups(self) -> FakeGroups:
+        return FakeGroups(self.google)
+
+    def members(self) -> FakeMembers:
+        return FakeMembers(self.google)
+
+    def licenseAssignments(self) -> FakeLicenseAssignments:
+        return FakeLicenseAssignments(self.google)
+
+    def new_batch_http_request(self, callback=None) -> FakeBatch:
+        return FakeBatch(self.google, callback)
+
+
+class FakeCursor:
+    """Stand in for an oracledb cursor that returns the synthetic students for the joined students and schools query."""
+
+    def __init__(self, rows: list):
+        self.rows = rows  # every synthetic row, already in the school_number, student_number DESC order of the query
+        self.arraysize = 100
+        self.prefetchrows = 2
+        self.results = iter([])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, statement: str, parameters: dict = None, **kwargs):
+        binds = dict(parameters or {}, **kwargs)
+        badNames = {value for key, value in binds.items() if key.startswith('bad')}
+        limited = 'State_ExcludeFromReporting = 0' in statement
+        school = int(binds['school']) if 'school' in binds else None
+        self.results = (row for row in self.rows if (not limited or row[9] == 0) and (school is None or row[5] == school)
+                        and str(row[1]).lower() not in badNames and str(row[2]).lower() not in badNames)
+
+    def __iter__(self):
+        return self.results
+
+    def fetchall(self) -> list:
+        return list(self.results)
+
+
+class FakeConnection:
+    """Stand in for an oracledb connection."""
+
+    version = '19.0.0.0.0'
+
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self.rows)
+
+
+def generate_data(studentCount: int, google: FakeGoogle, currentYear: int, studentsync) -> list:
+    """Generate the synthetic PowerSchool rows, and the matching Google accounts with some drift, returning the rows in query order."""
+    rng = random.Random(1)
+    schools = {school[1]: school for school in BENCHMARK_SCHOOLS}
+    limitedSchools = [school[1] for school in BENCHMARK_SCHOOLS if school[3] == 0]
+    rows = []
+    for index in range(studentCount):
+        studentNumber = 100000 + index
+        if rng.random() < LIMITED_SHARE:  # an active student in one of the real buildings
+            schoolNumber = rng.choice(limitedSchools)
+            grade = rng.randint(0, 12)
+            enroll = rng.choice([0, 0, 0, 0, 0, 0, 0, 0, 2, -1])
+        elif rng.random() < 0.05:  # pre-registered
+            schoolNumber, grade, enroll = 901, rng.randint(0, 12), -1
+        else:  # a graduated or old student, which is most of the district history
+            schoolNumber, grade, enroll = 999999, 99, rng.choice([3, 3, 3, 2])
+        gradYear = currentYear + 12 - grade if grade <= 12 else rng.randint(currentYear - 15, currentYear)
+        school = schools[schoolNumber]
+        rows.append((studentNumber, f'first{index}', f'last{index}', gradYear, enroll, schoolNumber, grade, school[0], school[2], school[3]))
+
+        if rng.random() < EXISTING_ACCOUNT_SHARE:  # give most students an existing account that matches PowerSchool, with a few that have drifted
+            email = f'{studentNumber}@d118.org'
+            aliases = []
+            if rng.random() < ALIAS_SHARE:  # the account was renamed and the student number email was kept as an alias
+                aliases = [email]
+                email = f'first{index}.last{index}@d118.org'
+                google.aliases[aliases[0]] = email
+            suspended = enroll not in (0, -1)
+            if schoolNumber == 999999:  # put the account where the sync would, using the OU constants from the main script
+                orgUnit = studentsync.GRADUATED_OU
+            elif suspended:
+                orgUnit = studentsync.SUSPENDED_OU
+            else:
+                orgUnit = studentsync.OU_PREFIX + school[2] + ' Students' + (studentsync.GRADE_OUS.get(grade) if schoolNumber != 901 and enroll != -1 else '')
+            user = {'primaryEmail': email, 'aliases': aliases, 'suspended': suspended, 'orgUnitPath': orgUnit,
+                    'name': {'givenName': f'First{index}', 'familyName': f'Last{index}'},
+                    'customSchemas': {'Synchronization_Data': {'Homeschool_ID': schoolNumber, 'Graduation_Year': gradYear}}}
+            if rng.random() < DRIFT_SHARE:  # half of the drifted accounts need to be suspended or unsuspended, the other half have had a name change
+                if rng.random() < 0.5:
+                    user['suspended'] = not suspended
+                else:
+                    user['name']['familyName'] = f'Old{index}'
+            google.users[email] = user
+            if rng.random() < 0.3:
+                google.groups[email] = [{'email': f'group{index % 50}@d118.org', 'name': f'Group {index % 50}'}]
+            if rng.random() < 0.5:
+                google.licenses.add(email)
+    for index in range(int(studentCount * BAD_NAME_SHARE)):  # dummy accounts spread across every school, with mixed case names since the query compares them lowercased
+        school = rng.choice(BENCHMARK_SCHOOLS)
+        badName = rng.choice(studentsync.BAD_NAMES).title()
+        firstName, lastName = (badName, f'last{index}') if rng.random() < 0.5 else (f'first{index}', badName)
+        rows.append((200000 + index, firstName, lastName, currentYear, 0, school[1], 5, school[0], school[2], school[3]))
+    rows.sort(key=lambda row: (row[5], -row[0]))
+    return rows
+
+
+def install_fakes(holder: dict) -> None:
+    """Put the fake oracledb and Google modules in sys.modules so studentsync imports them instead of the real ones.
+
+    holder is a dict whose 'google' and 'rows' entries are swapped out before each run, so a fresh data set can be used for each mode.
+    """
+    modules = {name: types.ModuleType(name) for name in ['oracledb', 'google', 'google.auth', 'google.auth.transport', 'google.auth.transport.requests', 'google.oauth2',
+                                                         'google.oauth2.credentials', 'google_auth_oauthlib', 'google_auth_oauthlib.flow', 'googleapiclient',
+                                                         'googleapiclient.discovery', 'googleapiclient.errors']}
+    modules['oracledb'].connect = lambda **kwargs: FakeConnection(holder['rows'])
+    modules['google.auth.transport.requests'].Request = object
+    modules['google.oauth2.credentials'].Credentials = object
+    modules['google_auth_oauthlib.flow'].InstalledAppFlow = object
+    modules['googleapiclient.discovery'].build = lambda *args, **kwargs: FakeService(holder['google'])
+    modules['googleapiclient.errors'].HttpError = FakeHttpError
+    sys.modules.update(modules)
+
+
+def run_benchmark(studentCount: int, modes: list, latency: float, errorRate: float, workers: int, quota: float, measureMemory: bool = True) -> None:
+    """Run sync_students for each mode and print the results. The timing comes from an untraced run, and if measureMemory is set a second run
+    is done with tracemalloc on just for the peak memory, since tracing slows the Python side down several times over.
+    """
+    holder = {}
+    install_fakes(holder)
+    import studentsync  # imported after the fakes are installed so it picks them up
+    studentsync.get_credentials = lambda: None  # there is no token.json to read
+    if quota:
+        studentsync.GOOGLE_REQUESTS_PER_SECOND = quota
+
+    workDir = tempfile.mkdtemp(prefix='syncbenchmark')
+    originalDir = os.getcwd()
+    os.chdir(workDir)  # run in the temp directory so the log and state files do not overwrite the real ones
+    try:
+        print(f'Benchmarking {studentCount} synthetic students, {latency}s latency per round trip, {errorRate:.1%} error rate, {workers} workers, {studentsync.GOOGLE_REQUESTS_PER_SECOND} requests per second quota')
+        print(f'{"mode":<10}{"students":>10}{"seconds":>10}{"students/s":>12}{"calls":>10}{"calls/student":>15}{"round trips":>13}{"errors":>8}{"peak MB":>10}')
+        def run(mode: str, traced: bool = False) -> tuple:
+            """Run one sync of mode against freshly generated data and an empty SyncState, returning the fake Google, the seconds it took and the peak traced bytes if traced."""
+            google = FakeGoogle(latency, errorRate)
+            holder['google'] = google
+            holder['rows'] = generate_data(studentCount, google, time.localtime().tm_year, studentsync)
+            if os.path.exists(studentsync.STATE_DATABASE):
+                os.remove(studentsync.STATE_DATABASE)
+            if traced:  # started after the data is generated so only the sync itself is counted
+                tracemalloc.start()
+            startTime = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # the console output would swamp the results and slow down the run
+                studentsync.sync_students(mode, workers=workers)
+            elapsed = time.perf_counter() - startTime
+            peak = 0
+            if traced:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            return google, elapsed, peak
+
+        for mode in modes:
+            google, elapsed, peak = run(mode)
+            processed = sum(building['students'] for building in studentsync.metrics.buildings.values())  # the students that actually came back from the query for this mode
+            calls = sum(google.calls.values())
+            peakMB = f'{run(mode, traced=True)[2] / 1048576:.1f}' if measureMemory else '-'  # a separate traced run so the tracing overhead does not end up in the timing
+            print(f'{mode:<10}{processed:>10}{elapsed:>10.2f}{processed / elapsed:>12.1f}{calls:>10}{calls / max(processed, 1):>15.3f}{google.roundTrips:>13}{google.errors:>8}{peakMB:>10}')
+            print('    ' + ', '.join(f'{endpoint}: {count}' for endpoint, count in sorted(google.calls.items())))
+    finally:
+        os.chdir(originalDir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of sync_students against fake Google and PowerSchool data')
+    parser.add_argument('--students', type=int, default=20000, help='number of synthetic students to generate')
+    parser.add_argument('--modes', nargs='+', default=['limited', 'full'], help='school modes to run sync_students with')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds each fake HTTP round trip takes')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of fake requests that return a 403/429 quota error')
+    parser.add_argument('--workers', type=int, default=1, help='workers to pass to sync_students')
+    parser.add_argument('--quota', type=float, default=None, help='override GOOGLE_REQUESTS_PER_SECOND, set it high to measure the script itself instead of the quota')
+    parser.add_argument('--no-memory', action='store_true', help='skip the second run with tracemalloc on that measures the peak memory')
+    args = parser.parse_args()
+    run_benchmark(args.students, args.modes, args.latency, args.error_rate, args.workers, args.quota, not args.no_memory)